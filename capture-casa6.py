@@ -15,17 +15,26 @@
 
 
 
+import concurrent.futures
+import glob
+import json
 import logging
+import multiprocessing
 import os
+import pickle
+import queue
+import shutil
+import subprocess
+import tempfile
 import numpy as np
 from datetime import datetime
 import casatasks as cts
 
-logfile_name = datetime.now().strftime('capture_%H_%M_%S_%d_%m_%Y.log')
-logging.basicConfig(filename=logfile_name,level=logging.DEBUG)
+# microseconds in the name keep two runs started in the same second from writing to one log
+logfile_name = datetime.now().strftime('capture_%H_%M_%S_%f_%d_%m_%Y.log')
 console = logging.StreamHandler()
 console.setLevel(logging.INFO)
-logging.getLogger('').addHandler(console)
+logging.basicConfig(handlers=[logging.FileHandler(logfile_name, delay=True), console], level=logging.DEBUG)
 
 logging.info("#######################################################################################")
 logging.info("You are using the CASA-6 compatible version of CAPTURE: CAsa Pipeline-cum-Toolkit for Upgraded GMRT data REduction.")
@@ -43,6 +52,10 @@ import configparser
 config = configparser.ConfigParser()
 config.read('config_capture.ini')
 
+def getfloatlist(mysection,mykey):
+        '''Returns a comma separated entry of the config file as a list of floats.'''
+        return [float(x) for x in config.get(mysection,mykey).split(',')]
+
 fromlta = config.getboolean('basic', 'fromlta')
 fromfits = config.getboolean('basic', 'fromfits')
 frommultisrcms = config.getboolean('basic','frommultisrcms')
@@ -70,10 +83,10 @@ splitfilename =config.get('basic','splitfilename')
 splitavgfilename = config.get('basic','splitavgfilename')
 setquackinterval = config.getfloat('basic','setquackinterval')
 ref_ant = config.get('basic','ref_ant')
-clipfluxcal = [float(config.get('basic','clipfluxcal').split(',')[0]),float(config.get('basic','clipfluxcal').split(',')[1])]
-clipphasecal =[float(config.get('basic','clipphasecal').split(',')[0]),float(config.get('basic','clipphasecal').split(',')[1])]
-cliptarget =[float(config.get('basic','cliptarget').split(',')[0]),float(config.get('basic','cliptarget').split(',')[1])]   
-clipresid=[float(config.get('basic','clipresid').split(',')[0]),float(config.get('basic','clipresid').split(',')[1])]
+clipfluxcal = getfloatlist('basic','clipfluxcal')
+clipphasecal = getfloatlist('basic','clipphasecal')
+cliptarget = getfloatlist('basic','cliptarget')
+clipresid = getfloatlist('basic','clipresid')
 chanavg = config.getint('basic','chanavg')
 subbandchan = config.getint('basic','subbandchan')
 imcellsize = [config.get('basic','imcellsize')]
@@ -89,10 +102,21 @@ nwprojpl = config.getint('basic','nwprojpl')
 uvracal=config.get('default','uvracal')
 uvrascal=config.get('default','uvrascal')
 target = config.getboolean('default','target')
+ncpu = config.getint('default','ncpu',fallback=1)
+reusecal = config.getboolean('default','reusecal',fallback=False)
+verbose_flagsummary = config.getboolean('default','verbose_flagsummary',fallback=False)
+selfcal_convtol = config.getfloat('default','selfcal_convtol',fallback=0.0)
+niter_end = config.getint('default','niter_end',fallback=150000)
+imaging_tmpdir = config.get('default','imaging_tmpdir',fallback='')
 
 
 exec(open("./ugfunctions.py").read())
 
+# Calibrator names are read once; set lookups keep the field classification linear.
+stdcals = frozenset(['3C48','3C147','3C286','0542+498','1331+305','0137+331'])
+with open('./vla-cals.list') as vlacalsfile:
+        vlacals = frozenset(vlacalsfile.read().split())
+
 testfitsfile = False
 
 if fromlta == True:
@@ -103,20 +127,31 @@ if fromlta == True:
                 testlistscan = os.path.isfile(gvbinpath[0])
                 testgvfits = os.path.isfile(gvbinpath[1])
                 if testlistscan and testgvfits == True:
-                        os.system(gvbinpath[0]+' '+ltafile)
+                        ltalogfile = ltafile.split('.')[0]+'.log'
+# the log also holds the output FITS name from fits_file, so it is made again when config_capture.ini changes
+                        if myisnewer(ltalogfile,[ltafile,'config_capture.ini']):
+                                logging.info("The file %s is newer than the lta file and config_capture.ini, listscan will not be run again.", ltalogfile)
+                        else:
+                                myrun = subprocess.run([gvbinpath[0].strip(), ltafile])
+                                if myrun.returncode != 0:
+                                        logging.info("listscan exited with status %d.", myrun.returncode)
                         if fits_file!= '' and fits_file != 'TEST.FITS':
-                                os.system("sed -i 's/TEST.FITS/'"+fits_file+"/ "+ltafile.split('.')[0]+'.log')
-                        try:
-                                assert os.path.isfile(fits_file)
+                                with open(ltalogfile) as f:
+                                        ltalog = f.read()
+                                if 'TEST.FITS' in ltalog:
+                                        with open(ltalogfile,'w') as f:
+                                                f.write(ltalog.replace('TEST.FITS',fits_file))
+                        if os.path.isfile(fits_file):
+                                testfitsfile = True
+                        elif os.path.isfile('TEST.FITS'):
+                                logging.info("The file TEST.FITS file already exists. New will not be created.")
+                                testfitsfile = True
+                                fits_file = 'TEST.FITS'
+                        else:
+                                myrun = subprocess.run([gvbinpath[1].strip(), ltalogfile])
+                                if myrun.returncode != 0:
+                                        logging.info("gvfits exited with status %d.", myrun.returncode)
                                 testfitsfile = True
-                        except AssertionError:
-                                if os.path.isfile('TEST.FITS') == True: 
-                                        logging.info("The file TEST.FITS file already exists. New will not be created.")
-                                        testfitsfile = True
-                                        fits_file = 'TEST.FITS'
-                                else:
-                                        os.system(gvbinpath[1]+' '+ltafile.split('.')[0]+'.log')
-                                        testfitsfile = True
                 else:        
                         logging.info("Error: Check if listscan and gvfits are present and executable.")
         else:
@@ -129,35 +164,40 @@ testfitsfile = False
 
 if fromfits == True:
         if fits_file != '':
-                try:
-                        assert os.path.isfile(fits_file)
+                if os.path.isfile(fits_file):
                         testfitsfile = True
-                except AssertionError:
-                        try:
-                                assert os.path.isfile('TEST.FITS')
-                                testfitsfile = True
-                        except AssertionError:
-                                logging.info("Please provide the name of the FITS file.")
-                                sys.exit()
+                elif os.path.isfile('TEST.FITS'):
+                        testfitsfile = True
+                        fits_file = 'TEST.FITS'
+                else:
+                        logging.info("Please provide the name of the FITS file.")
+                        sys.exit()
 
                 
 
 if testfitsfile == True:
         if msfilename != '':
-                try:
-                        assert os.path.isdir(msfilename), "The given msfile already exists, will not create new."
-                except AssertionError:
+                if not os.path.isdir(msfilename):
                         logging.info("The given msfile does not exist, will create new.")
         else:
-                try:
-                        assert os.path.isdir(fits_file+'.MS')
-                except AssertionError:
-                        msfilename = fits_file+'.MS'           
-        default(importgmrt)
-        importgmrt(fitsfile=fits_file, vis = msfilename)
-        if os.path.isfile(msfilename+'.list') == True:
-                os.system('rm '+msfilename+'.list')
-        vislistobs(msfilename)
+                msfilename = fits_file+'.MS'
+# an existing MS is reused and never overwritten; the .importing marker is only present while importgmrt runs,
+# so if it is still there the MS was left half-written by an interrupted import and is made again
+        importingmarker = msfilename+'.importing'
+        if os.path.exists(importingmarker):
+                logging.info("The import of %s did not finish in an earlier run, it will be imported again.", msfilename)
+                myrm(msfilename,msfilename+'.flagversions',msfilename+'.list')
+        if os.path.isdir(msfilename):
+                logging.info("The MS file %s exists, it will not be imported again.", msfilename)
+                if not myisnewer(msfilename+'/table.dat',[fits_file]):
+                        logging.info("The FITS file %s is newer than the MS, remove the MS to import it again.", fits_file)
+        else:
+                open(importingmarker,'w').close()
+                default(importgmrt)
+                importgmrt(fitsfile=fits_file, vis = msfilename)
+                myrm(msfilename+'.list')
+                vislistobs(msfilename)
+                myrm(importingmarker)
         logging.info("Please see the text file with the extension .list to find out more about your data.")
         
 
@@ -167,72 +207,59 @@ testms = False
 if frommultisrcms == True:
         if msfilename != '':
                 testms = os.path.isdir(msfilename)
+        elif os.path.isdir('TEST.FITS.MS'):
+                testms = True
+                msfilename = 'TEST.FITS.MS'
         else:
-                try:
-                        assert os.path.isdir('TEST.FITS.MS')
-                        testms = True
-                        msfilename = 'TEST.FITS.MS'
-                except AssertionError:
-                        logging.info("Tried to find the MS file with default name. File not found. Please provide the name of the msfile or create the MS by setting fromfits = True.")
-                        sys.exit()
+                logging.info("Tried to find the MS file with default name. File not found. Please provide the name of the msfile or create the MS by setting fromfits = True.")
+                sys.exit()
         if testms == False:
                 logging.info("The MS file does not exist. Please provide msfilename. Exiting the code...")
                 sys.exit()
 
 
 if testms == True:
-        gainspw, mygoodchans, flagspw, mypol = getgainspw(msfilename)
+# the channel frequencies and the number of channels are read once and passed to the helpers that need them
+        myfreqs = np.asarray(freq_info(msfilename))
+        mynchan = getnchan(msfilename)
+        gainspw, mygoodchans, flagspw, mypol, poldata = getgainspw(msfilename,myfreqs,mynchan)
         logging.info("Channel range for calibration:")
-        logging.info(gainspw)
+        logging.info('%s', gainspw)
         logging.info("Assumed clean channel range:")
-        logging.info(mygoodchans)
+        logging.info('%s', mygoodchans)
         logging.info("Channel range for flagging:")
-        logging.info(flagspw)
+        logging.info('%s', flagspw)
         logging.info("Polarizations in the file:")
-        logging.info(mypol)
+        logging.info('%s', mypol)
 # fix targets
         myfields = getfields(msfilename)
-        stdcals = ['3C48','3C147','3C286','0542+498','1331+305','0137+331']
-        vlacals = np.loadtxt('./vla-cals.list',dtype='str')
-        myampcals =[]
-        mypcals=[]
-        mytargets=[]
-        for i in range(0,len(myfields)):
-                if myfields[i] in stdcals:
-                        myampcals.append(myfields[i])
-                elif myfields[i] in vlacals:
-                        mypcals.append(myfields[i])
-                else:
-                        mytargets.append(myfields[i])
+        myampcals = [f for f in myfields if f in stdcals]
+        mypcals = [f for f in myfields if f in vlacals and f not in stdcals]
+        mytargets = [f for f in myfields if f not in stdcals and f not in vlacals]
         mybpcals = myampcals
-        logging.info('Amplitude caibrators are %s', str(myampcals))
-        logging.info('Phase calibrators are %s', str(mypcals))
-        logging.info('Target sources are %s', str(mytargets))
+        logging.info('Amplitude caibrators are %s', myampcals)
+        logging.info('Phase calibrators are %s', mypcals)
+        logging.info('Target sources are %s', mytargets)
 # need a condition to see if the pcal is same as 
-        ampcalscans =[]
-        for i in range(0,len(myampcals)):
-                ampcalscans.extend(getscans(msfilename, myampcals[i]))
-        pcalscans=[]
-        for i in range(0,len(mypcals)):
-                pcalscans.extend(getscans(msfilename, mypcals[i]))
-        tgtscans=[]
-        for i in range(0,len(mytargets)):
-                tgtscans.extend(getscans(msfilename,mytargets[i]))
+        scansbyfield = getscansbyfield(msfilename)
+        ampcalscans = [x for f in myampcals for x in scansbyfield.get(f,[])]
+        pcalscans = [x for f in mypcals for x in scansbyfield.get(f,[])]
+        tgtscans = [x for f in mytargets for x in scansbyfield.get(f,[])]
 #        print(ampcalscans)
         logging.info("Amplitude calibrator scans are:")
-        logging.info(ampcalscans)
+        logging.info('%s', ampcalscans)
 #        print(pcalscans)
         logging.info("Phase calibrator scans are:")
-        logging.info(pcalscans)
+        logging.info('%s', pcalscans)
 #        print(tgtscans)
         logging.info("Target source scans are:")
-        logging.info(tgtscans)
+        logging.info('%s', tgtscans)
         allscanlist= ampcalscans+pcalscans+tgtscans
 ###################################
 # get a list of antennas
         antsused = getantlist(msfilename,int(allscanlist[0]))
         logging.info("Antennas in the file:")
-        logging.info(antsused)
+        logging.info('%s', antsused)
 ###################################
 # find band ants
         if flagbadants==True:
@@ -241,48 +268,50 @@ if testms == True:
                 myantlist = antsused
                 mycmds = []
 #############
-                meancutoff = getbandcut(msfilename)
+                meancutoff = getbandcut(msfilename,myfreqs)
 #############
                 mycorr1='rr'
                 mycorr2='ll'
                 mygoodchans1=mygoodchans
                 mycalscans = ampcalscans+pcalscans
                 logging.info("Calibrator scan numbers:")
-                logging.info(mycalscans)
+                logging.info('%s', mycalscans)
                 allbadants=[]
+# the correlations to check do not change between antennas and scans
+                if mypol == 1:
+                        if poldata == 'RR':
+                                mycorrs = [mycorr1]
+                        elif poldata == 'LL':
+                                mycorrs = [mycorr2]
+                else:
+                        mycorrs = [mycorr1, mycorr2]
+                def getantmean(myant,myscan):
+                        return min([myvisstatampraw(msfilename,mygoodchans,myant,mycorr,myscan) for mycorr in mycorrs])
+# the visstat calls for all the calibrator scans and antennas are independent and are spread over ncpu processes
+                allantmeans = myparmap(getantmean,[(myant,str(myscan)) for myscan in mycalscans for myant in myantlist],ncpu)
+                nants = len(myantlist)
                 for j in range(0,len(mycalscans)):
-                        myantmeans = []
                         badantlist = []
+                        myantmeans = allantmeans[j*nants:(j+1)*nants]
                         for i in range(0,len(myantlist)):
-                                if mypol == 1:
-                                        if poldata == 'RR':
-                                                oneantmean1 = myvisstatampraw(msfilename,mygoodchans,myantlist[i],mycorr1,str(mycalscans[j]))
-                                                oneantmean2 =oneantmean1*100.
-                                        elif poldata == 'LL':
-                                                oneantmean2 = myvisstatampraw(msfilename,mygoodchans,myantlist[i],mycorr2,str(mycalscans[j]))
-                                                oneantmean1=oneantmean2*100.
-                                else:
-                                        oneantmean1 = myvisstatampraw(msfilename,mygoodchans,myantlist[i],mycorr1,str(mycalscans[j]))
-                                        oneantmean2 = myvisstatampraw(msfilename,mygoodchans,myantlist[i],mycorr2,str(mycalscans[j]))
-                                oneantmean = min(oneantmean1,oneantmean2)
-                                myantmeans.append(oneantmean)
+                                oneantmean = myantmeans[i]
                                 if oneantmean < meancutoff:
                                         badantlist.append(myantlist[i])
                                         allbadants.append(myantlist[i])
                         logging.info("The following antennas are bad for the given scan numbers.")
-                        logging.info('%s, %s',str(badantlist), str(mycalscans[j]))
+                        logging.info('%s, %s', badantlist, mycalscans[j])
                         if badantlist!=[]:
-                                myflgcmd = "mode='manual' antenna='%s' scan='%s'" % (str('; '.join(badantlist)), str(mycalscans[j]))
+                                myflgcmd = "mode='manual' antenna='%s' scan='%s'" % ('; '.join(badantlist), mycalscans[j])
                                 mycmds.append(myflgcmd)
                                 logging.info(myflgcmd)
                                 onelessscan = mycalscans[j] - 1
                                 onemorescan = mycalscans[j] + 1
                                 if onelessscan in tgtscans:
-                                        myflgcmd = "mode='manual' antenna='%s' scan='%s'" % (str('; '.join(badantlist)), str(mycalscans[j]-1))
+                                        myflgcmd = "mode='manual' antenna='%s' scan='%s'" % ('; '.join(badantlist), mycalscans[j]-1)
                                         mycmds.append(myflgcmd)
                                         logging.info(myflgcmd)
                                 if onemorescan in tgtscans:
-                                        myflgcmd = "mode='manual' antenna='%s' scan='%s'" % (str('; '.join(badantlist)), str(mycalscans[j]+1))
+                                        myflgcmd = "mode='manual' antenna='%s' scan='%s'" % ('; '.join(badantlist), mycalscans[j]+1)
                                         mycmds.append(myflgcmd)
                                         logging.info(myflgcmd)
 # execute the flagging commands accumulated in cmds
@@ -294,13 +323,17 @@ if testms == True:
         if flagbadfreq==True:
                 findbadchans = True
         if findbadchans ==True:
-                rfifreqall =[0.36E09,0.3796E09,0.486E09,0.49355E09,0.8808E09,0.885596E09,0.7646E09,0.769092E09] # always bad
-                myfreqs =  freq_info(msfilename)
-                mybadchans=[]
-                for j in range(0,len(rfifreqall)-1,2):
-                        for i in range(0,len(myfreqs)):
-                                if (myfreqs[i] > rfifreqall[j] and myfreqs[i] < rfifreqall[j+1]): #(myfreqs[i] > 0.486E09 and myfreqs[i] < 0.49355E09):
-                                        mybadchans.append('0:'+str(i))
+# the bad channels are saved next to the MS and reused until its spectral windows change
+                rfichanfile = msfilename+'.rfichans.npy'
+                if myisnewer(rfichanfile,[msfilename+'/SPECTRAL_WINDOW/table.dat']):
+                        mybadidx = np.load(rfichanfile)
+                else:
+                        rfifreqall =np.array([0.36E09,0.3796E09,0.486E09,0.49355E09,0.8808E09,0.885596E09,0.7646E09,0.769092E09]) # always bad
+# a channel is bad if it lies inside any of the (low, high) frequency pairs above
+                        mybadmask = ((myfreqs[:,None] > rfifreqall[0::2]) & (myfreqs[:,None] < rfifreqall[1::2])).any(axis=1)
+                        mybadidx = np.nonzero(mybadmask)[0]
+                        np.save(rfichanfile,mybadidx)
+                mybadchans = ['0:'+str(i) for i in mybadidx]
                 mychanflag = str(', '.join(mybadchans))
                 if mybadchans!=[]:
                         myflgcmd = ["mode='manual' spw='%s'" % (mychanflag)]
@@ -311,458 +344,382 @@ if testms == True:
                         logging.info("None of the well-known RFI-prone frequencies were found in the data.")
 ############ Initial flagging ################
 if flaginit == True:
-        try:
-                assert os.path.isdir(msfilename), "flaginit = True but ms file not found."
-        except AssertionError:
-                logging.info("flaginit = True but ms file not found.")
-                sys.exit()
+        myrequire(msfilename, "flaginit = True but ms file not found.")
         casalog.filter('INFO')
+# All the initial flagging commands are collected and applied with a single flagdata call in list mode.
 #Step 1 : Flag the first channel.
-        default(flagdata)
-        flagdata(vis=msfilename, mode='manual', field='', spw='0:0', antenna='', correlation='', action='apply', savepars=True,
-                cmdreason='badchan', outfile='')
+        myflgcmds = ["mode='manual' spw='0:0' reason='badchan'"]
 #Step 3: Do a quack step 
-        default(flagdata)
-        flagdata(vis=msfilename, mode='quack', field='', spw='0', antenna='', correlation='', timerange='',
-                quackinterval=setquackinterval, quackmode='beg', action='apply', savepars=True, cmdreason='quackbeg',
-                outfile='')
-        default(flagdata)
-        flagdata(vis=msfilename, mode='quack', field='', spw='0', antenna='', correlation='', timerange='', quackinterval=setquackinterval,
-                quackmode='endb', action='apply', savepars=True, cmdreason='quackendb', outfile='')
-# Clip at high amp levels
+        myflgcmds.append("mode='quack' spw='0' quackinterval=%s quackmode='beg' reason='quackbeg'" % (setquackinterval))
+        myflgcmds.append("mode='quack' spw='0' quackinterval=%s quackmode='endb' reason='quackendb'" % (setquackinterval))
         if myampcals !=[]:
                 print ('MyAmpCals',myampcals)
-                default(flagdata)
-                flagdata(vis=msfilename,mode="clip", spw=flagspw,field=str(','.join(myampcals)), clipminmax=clipfluxcal, datacolumn="DATA",clipoutside=True, clipzeros=True, extendpols=False, 
-                        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-        if mypcals !=[]:
-                default(flagdata)
-                flagdata(vis=msfilename,mode="clip", spw=flagspw,field=str(','.join(mypcals)), clipminmax=clipphasecal, datacolumn="DATA",clipoutside=True, clipzeros=True, extendpols=False, 
-                        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-# After clip, now flag using 'tfcrop' option for flux and phase cal tight flagging
-                flagdata(vis=msfilename,mode="tfcrop", datacolumn="DATA", field=str(','.join(mypcals)), ntime="scan",
-                        timecutoff=5.0, freqcutoff=5.0, timefit="line",freqfit="line",flagdimension="freqtime", 
-                        extendflags=False, timedevscale=5.0,freqdevscale=5.0, extendpols=False,growaround=False,
-                        action="apply", flagbackup=True,overwrite=True, writeflags=True)
-# Now extend the flags (80% more means full flag, change if required)
-                flagdata(vis=msfilename,mode="extend",spw=flagspw,field=str(','.join(mypcals)),datacolumn="DATA",clipzeros=True,
-                         ntime="scan", extendflags=False, extendpols=True,growtime=80.0, growfreq=80.0,growaround=False,
-                         flagneartime=False, flagnearfreq=False, action="apply", flagbackup=True,overwrite=True, writeflags=True)
-######### target flagging ### clip first
+# Clip at high amp levels, then for the phase calibrators and the targets flag using 'tfcrop' and extend the flags
+# (80% more means full flag, change if required). Each entry is (fields, clip range, tfcrop cutoff, tfcrop fit).
+        myflagsets = [(myampcals, clipfluxcal, None, None), (mypcals, clipphasecal, 5.0, 'line')]
         if target == True:
-                if mytargets !=[]:
-                        flagdata(vis=msfilename,mode="clip", spw=flagspw,field=str(','.join(mytargets)), clipminmax=cliptarget, datacolumn="DATA",clipoutside=True, clipzeros=True, extendpols=False, 
-                                action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-# flagging with tfcrop before calibration
-                        default(flagdata)
-                        flagdata(vis=msfilename,mode="tfcrop", datacolumn="DATA", field=str(','.join(mytargets)), ntime="scan",
-                                timecutoff=6.0, freqcutoff=6.0, timefit="poly",freqfit="poly",flagdimension="freqtime", 
-                                extendflags=False, timedevscale=5.0,freqdevscale=5.0, extendpols=False,growaround=False,
-                                action="apply", flagbackup=True,overwrite=True, writeflags=True)
-# Now extend the flags (80% more means full flag, change if required)
-                        flagdata(vis=msfilename,mode="extend",spw=flagspw,field=str(','.join(mytargets)),datacolumn="DATA",clipzeros=True,
-                                 ntime="scan", extendflags=False, extendpols=True,growtime=80.0, growfreq=80.0,growaround=False,
-                                 flagneartime=False, flagnearfreq=False, action="apply", flagbackup=True,overwrite=True, writeflags=True)
+                myflagsets.append((mytargets, cliptarget, 6.0, 'poly'))
+        for myflds, myclip, mycutoff, myfit in myflagsets:
+                if myflds == []:
+                        continue
+                myfldstr = ','.join(myflds)
+                myflgcmds.append("mode='clip' spw='%s' field='%s' clipminmax=%s datacolumn='DATA' clipoutside=True clipzeros=True" % (flagspw, myfldstr, myclip))
+                if mycutoff != None:
+                        myflgcmds.append("mode='tfcrop' datacolumn='DATA' field='%s' ntime='scan' timecutoff=%s freqcutoff=%s timefit='%s' freqfit='%s' flagdimension='freqtime' extendflags=False" % (myfldstr, mycutoff, mycutoff, myfit, myfit))
+                        myflgcmds.append("mode='extend' spw='%s' field='%s' ntime='scan' extendpols=True growtime=80.0 growfreq=80.0 growaround=False flagneartime=False flagnearfreq=False" % (flagspw, myfldstr))
+        logging.info("Initial flagging commands:")
+        for myflgcmd in myflgcmds:
+                logging.info(myflgcmd)
+        default(flagdata)
+# the single backup taken here holds the flags from before flaginit, to restore with flagmanager if needed
+        flagdata(vis=msfilename, mode='list', inpfile=myflgcmds, action='apply', flagbackup=True, savepars=True)
+        if target == True and verbose_flagsummary == True:
 # Now summary
                 flagdata(vis=msfilename,mode="summary",datacolumn="DATA", extendflags=True, 
-                                name=msfilename+'summary.split', action="apply", flagbackup=True,overwrite=True, writeflags=True)        
-        logging.info("A flagging summary is provided for the MS file.")
-        flagsummary(msfilename)
+                                name=msfilename+'summary.split', action="apply", flagbackup=False,overwrite=True, writeflags=True)        
+        if verbose_flagsummary == True:
+                logging.info("A flagging summary is provided for the MS file.")
+                flagsummary(msfilename)
 #####################################################################
 # Calibration begins.
 if doinitcal == True:
-	assert os.path.isdir(msfilename)
-	try:
-		assert os.path.isdir(msfilename), "doinitcal = True but ms file not found."
-	except AssertionError:
-		logging.info("doinitcal = True but ms file not found.")
-		sys.exit()
+	myrequire(msfilename, "doinitcal = True but ms file not found.")
 	mycalsuffix = ''
+	ampcalsstr = ', '.join(myampcals)
+	pcalsstr = ', '.join(mypcals)
+	targetsstr = ', '.join(mytargets)
+	bpcalsstr = ','.join(mybpcals)
+	ktable = msfilename+'.K1'+mycalsuffix
+	g0table = msfilename+'.AP.G0'+mycalsuffix
+	bptable = msfilename+'.B1'+mycalsuffix
+	aptable = msfilename+'.AP.G'+mycalsuffix
+	fluxtable = msfilename+'.fluxscale'+mycalsuffix
 	casalog.filter('INFO')
 	clearcal(vis=msfilename)
-	for i in range(0,len(myampcals)):
-		default(setjy)
-		setjy(vis=msfilename, spw=flagspw, field=myampcals[i])
+	default(setjy)
+	setjy(vis=msfilename, spw=flagspw, field=ampcalsstr)
+# With reusecal the delay and bandpass tables from an earlier run are kept if they are newer than
+# the last flag backup of the MS, the config file and the tables they were solved with.
+	flagstamp = msfilename+'.flagversions/FLAG_VERSION_LIST'
+# The OBSERVATION sub-table is written by the import and left alone by clearcal and setjy, so a re-imported MS makes
+# the tables stale; without a flag backup to compare with, the tables are not reused.
+	calstamps = [flagstamp,msfilename+'/OBSERVATION/table.dat','config_capture.ini']
+	canreusecal = (reusecal == True and os.path.isfile(flagstamp))
 # Delay calibration  using the first flux calibrator in the list - should depend on which is less flagged
-	gntable=str(msfilename)+'.K1'+mycalsuffix
-	#if os.path.isdir(str(msfilename)+'.K1'+mycalsuffix) == True:
-	#	os.system('rm -rf '+str(msfilename)+'.K1'+mycalsuffix)
-	if os.path.isdir(gntable) == True:
-	        os.system('rm -rf '+gntable)
-	default(gaincal)
-	gaincal(vis=msfilename, caltable=gntable, spw =flagspw, field=myampcals[0], 
-		solint='60s', refant=ref_ant, solnorm= True, gaintype='K', gaintable=[], parang=True)
+	if canreusecal == True and myisnewer(ktable,calstamps):
+		logging.info("Reusing the existing table %s.", ktable)
+	else:
+		myrm(ktable)
+		default(gaincal)
+		gaincal(vis=msfilename, caltable=ktable, spw =flagspw, field=myampcals[0], 
+			solint='60s', refant=ref_ant, solnorm= True, gaintype='K', gaintable=[], parang=True)
 	kcorrfield =myampcals[0]
 # an initial bandpass
-	gntable=str(msfilename)+'.AP.G0'+mycalsuffix
-	#if os.path.isdir(str(msfilename)+'.AP.G0'+mycalsuffix) == True:
-	#	os.system('rm -rf '+str(msfilename)+'.AP.G0'+mycalsuffix)
-	if os.path.isdir(gntable) == True:
-		os.system('rm -rf '+gntable)
-	default(gaincal)
-	gaincal(vis=msfilename, caltable=gntable, append=False, field=str(','.join(mybpcals)), 
-		spw =flagspw, solint = 'int', refant = ref_ant, minsnr = 2.0, solmode = 'L1R', gaintype = 'G', calmode = 'ap', 
-		gaintable = [str(msfilename)+'.K1'+mycalsuffix], interp = ['nearest,nearestflag', 'nearest,nearestflag' ], parang = True)
-	if os.path.isdir(str(msfilename)+'.B1'+mycalsuffix) == True:
-		os.system('rm -rf '+str(msfilename)+'.B1'+mycalsuffix)
-	bptable=str(msfilename)+'.B1'+mycalsuffix
-	default(bandpass)
-	bandpass(vis=msfilename, caltable=bptable, spw =flagspw, field=str(','.join(mybpcals)), solint='inf', refant=ref_ant, solnorm = True,
-		minsnr=2.0, fillgaps=8, parang = True, gaintable=[str(msfilename)+'.K1'+mycalsuffix,str(msfilename)+'.AP.G0'+mycalsuffix], interp=['nearest,nearestflag','nearest,nearestflag'])
+	gntable=g0table
+	if canreusecal == True and myisnewer(gntable,calstamps+[ktable]):
+		logging.info("Reusing the existing table %s.", gntable)
+	else:
+		myrm(gntable)
+		default(gaincal)
+		gaincal(vis=msfilename, caltable=gntable, append=False, field=bpcalsstr, 
+			spw =flagspw, solint = 'int', refant = ref_ant, minsnr = 2.0, solmode = 'L1R', gaintype = 'G', calmode = 'ap', 
+			gaintable = [ktable], interp = ['nearest,nearestflag', 'nearest,nearestflag' ], parang = True)
+	if canreusecal == True and myisnewer(bptable,calstamps+[ktable,g0table]):
+		logging.info("Reusing the existing table %s.", bptable)
+	else:
+		myrm(bptable)
+		default(bandpass)
+		bandpass(vis=msfilename, caltable=bptable, spw =flagspw, field=bpcalsstr, solint='inf', refant=ref_ant, solnorm = True,
+			minsnr=2.0, fillgaps=8, parang = True, gaintable=[ktable,g0table], interp=['nearest,nearestflag','nearest,nearestflag'])
 # do a gaincal on all calibrators
 	mycals=myampcals+mypcals
-	i=0
-	if os.path.isdir(str(msfilename)+'.AP.G'+mycalsuffix) == True:
-		os.system('rm -rf '+str(msfilename)+'.AP.G'+mycalsuffix)
-	for i in range(0,len(mycals)):
-                if i == 0:
-                        appflag = False                   
-                else:
-                    if os.path.isdir(str(msfilename)+'.AP.G'+mycalsuffix) == True:
-                            appflag = True
-                    else:
-                            logging.info("Check gaincal table !!!! Was not created in the first step.")
-                            appflag = False
-                mygaincal_ap2(msfilename,mycals[i],ref_ant,gainspw,uvracal,mycalsuffix,appflag)
+	myrm(aptable)
+# gaincal solves for each field separately, so all the calibrators go in a single call.
+	mygaincal_ap2(msfilename,','.join(mycals),ref_ant,gainspw,uvracal,mycalsuffix,False)
 # Get flux scale
-	if os.path.isdir(str(msfilename)+'.fluxscale'+mycalsuffix) == True:
-		os.system('rm -rf '+str(msfilename)+'.fluxscale'+mycalsuffix)
+	myrm(fluxtable)
 ######################################
 	if mypcals !=[]:
 		if '3C286' in myampcals:
-			myfluxscale= getfluxcal2(msfilename,'3C286',str(', '.join(mypcals)),mycalsuffix)
+			myfluxscale= getfluxcal2(msfilename,'3C286',pcalsstr,mycalsuffix)
 			myfluxscaleref = '3C286'
 		elif '3C147' in myampcals:
-			myfluxscale= getfluxcal2(msfilename,'3C147',str(', '.join(mypcals)),mycalsuffix)
+			myfluxscale= getfluxcal2(msfilename,'3C147',pcalsstr,mycalsuffix)
 			myfluxscaleref = '3C147'
 		else:
-			myfluxscale= getfluxcal2(msfilename,myampcals[0],str(', '.join(mypcals)),mycalsuffix)
+			myfluxscale= getfluxcal2(msfilename,myampcals[0],pcalsstr,mycalsuffix)
 			myfluxscaleref = myampcals[0]
-		logging.info(myfluxscale)
-		mygaintables =[str(msfilename)+'.fluxscale'+mycalsuffix,str(msfilename)+'.K1'+mycalsuffix, str(msfilename)+'.B1'+mycalsuffix]
+		logging.info('%s', myfluxscale)
+		mygaintables =[fluxtable,ktable,bptable]
 	else:
-		mygaintables =[str(msfilename)+'.AP.G'+mycalsuffix,str(msfilename)+'.K1'+mycalsuffix, str(msfilename)+'.B1'+mycalsuffix]
+		mygaintables =[aptable,ktable,bptable]
+	mychecktables(mygaintables)
 ##############################
-	for i in range(0,len(myampcals)):
-		default(applycal)
-		applycal(vis=msfilename, field=myampcals[i], spw = flagspw, gaintable=mygaintables, gainfield=[myampcals[i],'',''], 
-			interp=['nearest','',''], calwt=[False], parang=False)
+# gainfield 'nearest' picks the solutions of each flux calibrator for itself, so they are all done in one call
+	default(applycal)
+	applycal(vis=msfilename, field=ampcalsstr, spw = flagspw, gaintable=mygaintables, gainfield=['nearest','',''], 
+		interp=['nearest','',''], calwt=[False], parang=False)
 #For phase calibrator:
 	if mypcals !=[]:
 		default(applycal)
-		applycal(vis=msfilename, field=str(', '.join(mypcals)), spw = flagspw, gaintable=mygaintables, gainfield=str(', '.join(mypcals)), 
+		applycal(vis=msfilename, field=pcalsstr, spw = flagspw, gaintable=mygaintables, gainfield=pcalsstr, 
 			interp=['nearest','','nearest'], calwt=[False], parang=False)
 #For the target:
 	if target ==True:
 		if mypcals !=[]:
 			default(applycal)
-			applycal(vis=msfilename, field=str(', '.join(mytargets)), spw = flagspw, gaintable=mygaintables,
-				gainfield=[str(', '.join(mypcals)),'',''],interp=['linear','','nearest'], calwt=[False], parang=False)
+			applycal(vis=msfilename, field=targetsstr, spw = flagspw, gaintable=mygaintables,
+				gainfield=[pcalsstr,'',''],interp=['linear','','nearest'], calwt=[False], parang=False)
 		else:
 			default(applycal)
-			applycal(vis=msfilename, field=str(', '.join(mytargets)), spw = flagspw, gaintable=mygaintables,
-				gainfield=[str(', '.join(myampcals)),'',''],interp=['linear','','nearest'], calwt=[False], parang=False)        
+			applycal(vis=msfilename, field=targetsstr, spw = flagspw, gaintable=mygaintables,
+				gainfield=[ampcalsstr,'',''],interp=['linear','','nearest'], calwt=[False], parang=False)        
 	plot_files = my_dig_plot(msfilename,myfields,myampcals,mypcals,mytargets,mycalsuffix,bptable,gntable)
 	logging.info("Finished initial calibration.")
-	logging.info("A flagging summary is provided for the MS file.")
-	flagsummary(msfilename)
+	if verbose_flagsummary == True:
+		logging.info("A flagging summary is provided for the MS file.")
+		flagsummary(msfilename)
 #############################################################################3
 #######Ishwar post calibration flagging
 if doflag == True:
-        try:
-                assert os.path.isdir(msfilename), "doflag = True but ms file not found."
-        except AssertionError:
-                logging.info("doflag = True but ms file not found.")
-                sys.exit()
+        myrequire(msfilename, "doflag = True but ms file not found.")
         logging.info("You have chosen to flag after the initial calibration.")
-        default(flagdata)
+# All the commands are applied with a single flagdata call in list mode, so the corrected data are read once.
+        ampcalsstr = ', '.join(myampcals)
+        pcalsstr = ', '.join(mypcals)
+        targetsstr = ', '.join(mytargets)
+        myflgcmds = []
         if myampcals !=[]:
-                flagdata(vis=msfilename,mode="clip", spw=flagspw,field=str(', '.join(myampcals)), clipminmax=clipfluxcal,
-                        datacolumn="corrected",clipoutside=True, clipzeros=True, extendpols=False, 
-                        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
+                myflgcmds.append("mode='clip' spw='%s' field='%s' clipminmax=%s datacolumn='corrected' clipoutside=True clipzeros=True" % (flagspw, ampcalsstr, clipfluxcal))
         if mypcals !=[]:
-                flagdata(vis=msfilename,mode="clip", spw=flagspw,field=str(', '.join(mypcals)), clipminmax=clipphasecal,
-                        datacolumn="corrected",clipoutside=True, clipzeros=True, extendpols=False, 
-                        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
+                myflgcmds.append("mode='clip' spw='%s' field='%s' clipminmax=%s datacolumn='corrected' clipoutside=True clipzeros=True" % (flagspw, pcalsstr, clipphasecal))
 # After clip, now flag using 'tfcrop' option for flux and phase cal tight flagging
-                flagdata(vis=msfilename,mode="tfcrop", datacolumn="corrected", field=str(', '.join(mypcals)), ntime="scan",
-                        timecutoff=6.0, freqcutoff=5.0, timefit="line",freqfit="line",flagdimension="freqtime", 
-                        extendflags=False, timedevscale=5.0,freqdevscale=5.0, extendpols=False,growaround=False,
-                        action="apply", flagbackup=True,overwrite=True, writeflags=True)
+                myflgcmds.append("mode='tfcrop' datacolumn='corrected' field='%s' ntime='scan' timecutoff=6.0 freqcutoff=5.0 timefit='line' freqfit='line' flagdimension='freqtime' extendflags=False" % (pcalsstr))
 # now flag using 'rflag' option  for flux and phase cal tight flagging
-                flagdata(vis=msfilename,mode="rflag",datacolumn="corrected",field=str(', '.join(mypcals)), timecutoff=5.0, 
-                        freqcutoff=5.0,timefit="poly",freqfit="line",flagdimension="freqtime", extendflags=False,
-                        timedevscale=4.0,freqdevscale=4.0,spectralmax=500.0,extendpols=False, growaround=False,
-                        flagneartime=False,flagnearfreq=False,action="apply",flagbackup=True,overwrite=True, writeflags=True)
+                myflgcmds.append("mode='rflag' datacolumn='corrected' field='%s' timedevscale=4.0 freqdevscale=4.0 spectralmax=500.0 extendflags=False" % (pcalsstr))
 # Now extend the flags (70% more means full flag, change if required)
-                flagdata(vis=msfilename,mode="extend",spw=flagspw,field=str(', '.join(mypcals)),datacolumn="corrected",clipzeros=True,
-                         ntime="scan", extendflags=False, extendpols=False,growtime=90.0, growfreq=90.0,growaround=False,
-                         flagneartime=False, flagnearfreq=False, action="apply", flagbackup=True,overwrite=True, writeflags=True)
+                myflgcmds.append("mode='extend' spw='%s' field='%s' ntime='scan' extendpols=False growtime=90.0 growfreq=90.0 growaround=False flagneartime=False flagnearfreq=False" % (flagspw, pcalsstr))
 # Now flag for target - moderate flagging, more flagging in self-cal cycles
         if mytargets !=[]:
-                flagdata(vis=msfilename,mode="clip", spw=flagspw,field=str(', '.join(mytargets)), clipminmax=cliptarget,
-                        datacolumn="corrected",clipoutside=True, clipzeros=True, extendpols=False, 
-                        action="apply",flagbackup=True, savepars=False, overwrite=True, writeflags=True)
-# C-C baselines are selected
+                myflgcmds.append("mode='clip' spw='%s' field='%s' clipminmax=%s datacolumn='corrected' clipoutside=True clipzeros=True" % (flagspw, targetsstr, cliptarget))
+# a has the C-C baselines, b the C-arm and arm-arm baselines
                 a, b = getbllists(msfilename)
-                flagdata(vis=msfilename,mode="tfcrop", datacolumn="corrected", field=str(', '.join(mytargets)), antenna=a[0],
-                        ntime="scan", timecutoff=8.0, freqcutoff=8.0, timefit="poly",freqfit="line",flagdimension="freqtime", 
-                        extendflags=False, timedevscale=5.0,freqdevscale=5.0, extendpols=False,growaround=False,
-                        action="apply", flagbackup=True,overwrite=True, writeflags=True)
-# C- arm antennas and arm-arm baselines are selected.
-                flagdata(vis=msfilename,mode="tfcrop", datacolumn="corrected", field=str(', '.join(mytargets)), antenna=b[0],
-                        ntime="scan", timecutoff=6.0, freqcutoff=5.0, timefit="poly",freqfit="line",flagdimension="freqtime", 
-                        extendflags=False, timedevscale=5.0,freqdevscale=5.0, extendpols=False,growaround=False,
-                        action="apply", flagbackup=True,overwrite=True, writeflags=True)
+                myflgcmds.append("mode='tfcrop' datacolumn='corrected' field='%s' antenna='%s' ntime='scan' timecutoff=8.0 freqcutoff=8.0 timefit='poly' freqfit='line' flagdimension='freqtime' extendflags=False" % (targetsstr, a[0]))
+                myflgcmds.append("mode='tfcrop' datacolumn='corrected' field='%s' antenna='%s' ntime='scan' timecutoff=6.0 freqcutoff=5.0 timefit='poly' freqfit='line' flagdimension='freqtime' extendflags=False" % (targetsstr, b[0]))
 # now flag using 'rflag' option
-# C-C baselines are selected
-                flagdata(vis=msfilename,mode="rflag",datacolumn="corrected",field=str(', '.join(mytargets)), timecutoff=5.0, antenna=a[0],
-                        freqcutoff=8.0,timefit="poly",freqfit="poly",flagdimension="freqtime", extendflags=False,
-                        timedevscale=8.0,freqdevscale=5.0,spectralmax=500.0,extendpols=False, growaround=False,
-                        flagneartime=False,flagnearfreq=False,action="apply",flagbackup=True,overwrite=True, writeflags=True)
-# C- arm antennas and arm-arm baselines are selected.
-                flagdata(vis=msfilename,mode="rflag",datacolumn="corrected",field=str(', '.join(mytargets)), timecutoff=5.0, antenna=b[0],
-                        freqcutoff=5.0,timefit="poly",freqfit="poly",flagdimension="freqtime", extendflags=False,
-                        timedevscale=5.0,freqdevscale=5.0,spectralmax=500.0,extendpols=False, growaround=False,
-                        flagneartime=False,flagnearfreq=False,action="apply",flagbackup=True,overwrite=True, writeflags=True)
+                myflgcmds.append("mode='rflag' datacolumn='corrected' field='%s' antenna='%s' timedevscale=8.0 freqdevscale=5.0 spectralmax=500.0 extendflags=False" % (targetsstr, a[0]))
+                myflgcmds.append("mode='rflag' datacolumn='corrected' field='%s' antenna='%s' timedevscale=5.0 freqdevscale=5.0 spectralmax=500.0 extendflags=False" % (targetsstr, b[0]))
+        if myflgcmds != []:
+                logging.info("Flagging commands on the calibrated data:")
+                for myflgcmd in myflgcmds:
+                        logging.info(myflgcmd)
+                default(flagdata)
+                flagdata(vis=msfilename, mode='list', inpfile=myflgcmds, action='apply', flagbackup=True)
 # Now summary
-        flagdata(vis=msfilename,mode="summary",datacolumn="corrected", extendflags=True, 
-                name=msfilename+'summary.split', action="apply", flagbackup=True,overwrite=True, writeflags=True)
-        logging.info("A flagging summary is provided for the MS file.")
-        flagsummary(msfilename)
+        if verbose_flagsummary == True:
+                flagdata(vis=msfilename,mode="summary",datacolumn="corrected", extendflags=True, 
+                        name=msfilename+'summary.split', action="apply", flagbackup=False,overwrite=True, writeflags=True)
+                logging.info("A flagging summary is provided for the MS file.")
+                flagsummary(msfilename)
 
 #################### new redocal #########################3
 # Calibration begins.
 if redocal == True:
-	try:
-		assert os.path.isdir(msfilename), "redocal = True but ms file not found."
-	except AssertionError:
-		logging.info("redocal = True but ms file not found.")
-		sys.exit()
+	myrequire(msfilename, "redocal = True but ms file not found.")
 	logging.info("You have chosen to redo the calibration on your data.")
 	mycalsuffix = 'recal'
+	ampcalsstr = ', '.join(myampcals)
+	pcalsstr = ', '.join(mypcals)
+	targetsstr = ', '.join(mytargets)
+	bpcalsstr = ','.join(mybpcals)
+	ktable = msfilename+'.K1'+mycalsuffix
+	g0table = msfilename+'.AP.G0'+mycalsuffix
+	bptable = msfilename+'.B1'+mycalsuffix
+	aptable = msfilename+'.AP.G'+mycalsuffix
+	fluxtable = msfilename+'.fluxscale'+mycalsuffix
 	casalog.filter('INFO')
 	clearcal(vis=msfilename)
-	for i in range(0,len(myampcals)):
-		default(setjy)
-		setjy(vis=msfilename, spw=flagspw, field=myampcals[i])
-		logging.info("Done setjy on %s"%(myampcals[i]))
+	default(setjy)
+	setjy(vis=msfilename, spw=flagspw, field=ampcalsstr)
+	logging.info("Done setjy on %s", myampcals)
 # Delay calibration  using the first flux calibrator in the list - should depend on which is less flagged
-	gntable=str(msfilename)+'.K1'+mycalsuffix
-	#if os.path.isdir(str(msfilename)+'.K1'+mycalsuffix) == True:
-	#	os.system('rm -rf '+str(msfilename)+'.K1'+mycalsuffix)
-	if os.path.isdir(gntable) == True:
-		os.system('rm -rf '+gntable)
+	myrm(ktable)
 	default(gaincal)
-	gaincal(vis=msfilename, caltable=gntable, spw =flagspw, field=myampcals[0],solint='60s', refant=ref_ant,solnorm= True, gaintype='K', gaintable=[], parang=True)
+	gaincal(vis=msfilename, caltable=ktable, spw =flagspw, field=myampcals[0],solint='60s', refant=ref_ant,solnorm= True, gaintype='K', gaintable=[], parang=True)
 	kcorrfield =myampcals[0]
-#        print 'wrote table',str(msfilename)+'.K1'+mycalsuffix
 # an initial bandpass
-	gntable=str(msfilename)+'.AP.G0'+mycalsuffix
-	#if os.path.isdir(str(msfilename)+'.AP.G0'+mycalsuffix) == True:
-	#	os.system('rm -rf '+str(msfilename)+'.AP.G0'+mycalsuffix)
-	if os.path.isdir(gntable) == True:
-		os.system('rm -rf '+gntable)
+	gntable=g0table
+	myrm(g0table)
 	default(gaincal)
-	gaincal(vis=msfilename, caltable=gntable, append=False, field=str(','.join(mybpcals)),spw =flagspw, solint = 'int', refant = ref_ant, minsnr = 2.0, solmode ='L1R', gaintype = 'G', calmode = 'ap', gaintable = [str(msfilename)+'.K1'+mycalsuffix],interp = ['nearest,nearestflag', 'nearest,nearestflag' ], parang = True)
-	if os.path.isdir(str(msfilename)+'.B1'+mycalsuffix) == True:
-		os.system('rm -rf '+str(msfilename)+'.B1'+mycalsuffix)
-	bptable=str(msfilename)+'.B1'+mycalsuffix
+	gaincal(vis=msfilename, caltable=g0table, append=False, field=bpcalsstr,spw =flagspw, solint = 'int', refant = ref_ant, minsnr = 2.0, solmode ='L1R', gaintype = 'G', calmode = 'ap', gaintable = [ktable],interp = ['nearest,nearestflag', 'nearest,nearestflag' ], parang = True)
+	myrm(bptable)
 	default(bandpass)
-	bandpass(vis=msfilename, caltable=bptable, spw =flagspw, field=str(','.join(mybpcals)), solint='inf', refant=ref_ant, solnorm = True,
-		minsnr=2.0, fillgaps=8, parang = True, gaintable=[str(msfilename)+'.K1'+mycalsuffix,str(msfilename)+'.AP.G0'+mycalsuffix], interp=['nearest,nearestflag','nearest,nearestflag'])
+	bandpass(vis=msfilename, caltable=bptable, spw =flagspw, field=bpcalsstr, solint='inf', refant=ref_ant, solnorm = True,
+		minsnr=2.0, fillgaps=8, parang = True, gaintable=[ktable,g0table], interp=['nearest,nearestflag','nearest,nearestflag'])
 # do a gaingal on all calibrators
 	mycals=myampcals+mypcals
-	i=0
-	if os.path.isdir(str(msfilename)+'.AP.G'+mycalsuffix) == True:
-		os.system('rm -rf '+str(msfilename)+'.AP.G'+mycalsuffix)
-	for i in range(0,len(mycals)):
-		if i == 0:
-			appflag = False
-		else:
-			if os.path.isdir(str(msfilename)+'.AP.G'+mycalsuffix) == True:
-				appflag = True
-			else:
-				logging.info("Check gaincal table !!!! Was not created in the first step.")
-				appflag = False
-		mygaincal_ap2(msfilename,mycals[i],ref_ant,gainspw,uvracal,mycalsuffix,appflag)
+	myrm(aptable)
+# gaincal solves for each field separately, so all the calibrators go in a single call.
+	mygaincal_ap2(msfilename,','.join(mycals),ref_ant,gainspw,uvracal,mycalsuffix,False)
 # Get flux scale
-	if os.path.isdir(str(msfilename)+'.fluxscale'+mycalsuffix) == True:
-		os.system('rm -rf '+str(msfilename)+'.fluxscale'+mycalsuffix)
+	myrm(fluxtable)
 ########################################
 	if mypcals !=[]:
 		if '3C286' in myampcals:
-			myfluxscale= getfluxcal2(msfilename,'3C286',str(', '.join(mypcals)),mycalsuffix)
+			myfluxscale= getfluxcal2(msfilename,'3C286',pcalsstr,mycalsuffix)
 			myfluxscaleref = '3C286'
 		elif '3C147' in myampcals:
-			myfluxscale= getfluxcal2(msfilename,'3C147',str(', '.join(mypcals)),mycalsuffix)
+			myfluxscale= getfluxcal2(msfilename,'3C147',pcalsstr,mycalsuffix)
 			myfluxscaleref = '3C147'
 		else:
-			myfluxscale= getfluxcal2(msfilename,myampcals[0],str(', '.join(mypcals)),mycalsuffix)
+			myfluxscale= getfluxcal2(msfilename,myampcals[0],pcalsstr,mycalsuffix)
 			myfluxscaleref = myampcals[0]
-		logging.info(myfluxscale)
-		mygaintables =[str(msfilename)+'.fluxscale'+mycalsuffix,str(msfilename)+'.K1'+mycalsuffix, str(msfilename)+'.B1'+mycalsuffix]
+		logging.info('%s', myfluxscale)
+		mygaintables =[fluxtable,ktable,bptable]
 	else:
-		mygaintables =[str(msfilename)+'.AP.G'+mycalsuffix,str(msfilename)+'.K1'+mycalsuffix, str(msfilename)+'.B1'+mycalsuffix]
+		mygaintables =[aptable,ktable,bptable]
+	mychecktables(mygaintables)
 ###############################################################
-	for i in range(0,len(myampcals)):
-		default(applycal)
-		applycal(vis=msfilename, field=myampcals[i], spw = flagspw, gaintable=mygaintables, gainfield=[myampcals[i],'',''], 
-			interp=['nearest','',''], calwt=[False], parang=False)
+# gainfield 'nearest' picks the solutions of each flux calibrator for itself, so they are all done in one call
+	default(applycal)
+	applycal(vis=msfilename, field=ampcalsstr, spw = flagspw, gaintable=mygaintables, gainfield=['nearest','',''], 
+		interp=['nearest','',''], calwt=[False], parang=False)
 #For phase calibrator:
 	if mypcals !=[]:
 		default(applycal)
-		applycal(vis=msfilename, field=str(', '.join(mypcals)), spw = flagspw, gaintable=mygaintables, gainfield=str(', '.join(mypcals)), 
+		applycal(vis=msfilename, field=pcalsstr, spw = flagspw, gaintable=mygaintables, gainfield=pcalsstr, 
 			interp=['nearest','','nearest'], calwt=[False], parang=False)
 #For the target:
 	if target ==True:
 		if mypcals !=[]:
 			default(applycal)
-			applycal(vis=msfilename, field=str(', '.join(mytargets)), spw = flagspw, gaintable=mygaintables,
-				gainfield=[str(', '.join(mypcals)),'',''],interp=['linear','','nearest'], calwt=[False], parang=False)
+			applycal(vis=msfilename, field=targetsstr, spw = flagspw, gaintable=mygaintables,
+				gainfield=[pcalsstr,'',''],interp=['linear','','nearest'], calwt=[False], parang=False)
 		else:
 			default(applycal)
-			applycal(vis=msfilename, field=str(', '.join(mytargets)), spw = flagspw, gaintable=mygaintables,
-				gainfield=[str(', '.join(myampcals)),'',''],interp=['linear','','nearest'], calwt=[False], parang=False)                        
+			applycal(vis=msfilename, field=targetsstr, spw = flagspw, gaintable=mygaintables,
+				gainfield=[ampcalsstr,'',''],interp=['linear','','nearest'], calwt=[False], parang=False)                        
 	plot_files = my_dig_plot(msfilename,myfields,myampcals,mypcals,mytargets,mycalsuffix,bptable,gntable)
 	logging.info("Finished re-calibration.")
-	logging.info("A flagging summary is provided for the MS file.")
-	flagsummary(msfilename)
+	if verbose_flagsummary == True:
+		logging.info("A flagging summary is provided for the MS file.")
+		flagsummary(msfilename)
 #############################################################
 # SPLIT step
 #############################################################
+# with no flagging of the unaveraged split file in between, split and average are done in a single pass
+splitwithavg = (dosplit == True and dosplitavg == True and flagsplitfile == False)
 if dosplit == True:
-        try:
-                assert os.path.isdir(msfilename), "dosplit = True but ms file not found."
-        except AssertionError:
-                logging.info("dosplit = True but ms file not found.")
-                sys.exit()
+        myrequire(msfilename, "dosplit = True but ms file not found.")
         logging.info("The data on targets will be split into separate files.")
         casalog.filter('INFO')
 # fix targets
         myfields = getfields(msfilename)
-        stdcals = ['3C48','3C147','3C286','0542+498','1331+305','0137+331']
-        vlacals = np.loadtxt('./vla-cals.list',dtype='str')
-        myampcals =[]
-        mypcals=[]
-        mytargets=[]
-        for i in range(0,len(myfields)):
-                if myfields[i] in stdcals:
-                        myampcals.append(myfields[i])
-                elif myfields[i] in vlacals:
-                        mypcals.append(myfields[i])
-                else:
-                        mytargets.append(myfields[i])
-        gainspw1,goodchans,flg_chans,pols = getgainspw(msfilename)
+        myampcals = [f for f in myfields if f in stdcals]
+        mypcals = [f for f in myfields if f in vlacals and f not in stdcals]
+        mytargets = [f for f in myfields if f not in stdcals and f not in vlacals]
+        gainspw1,goodchans,flg_chans,pols,poldata = getgainspw(msfilename)
+        if splitwithavg == True:
+                mysplitprefix = 'avg-'
+        else:
+                mysplitprefix = ''
+# any existing split files are deleted
         for i in range(0,len(mytargets)):
-                if os.path.isdir(mytargets[i]+'split.ms') == True:
-                        logging.info("The existing split file will be deleted.")
-                        os.system('rm -rf '+mytargets[i]+'split.ms')
-                        os.system('rm -rf '+mytargets[i]+'split.ms.flagversions') #SGRBsplit.ms.flagversions
-                logging.info("Splitting target source data.")
-                logging.info(gainspw1)
-                splitfilename = mysplitinit(msfilename,mytargets[i],gainspw1,1,mytargets[i]+'split.ms')
+                myrm(mysplitprefix+mytargets[i]+'split.ms', mysplitprefix+mytargets[i]+'split.ms.flagversions') #SGRBsplit.ms.flagversions
+        logging.info("Splitting target source data.")
+        logging.info('%s', gainspw1)
+# each target goes to its own file, so the splits can run side by side on ncpu processes
+        if splitwithavg == True:
+                logging.info("Your data will be averaged in frequency.")
+                mysplitfiles = myparmap(mysplitinitavg,[(msfilename,mytargets[i],gainspw1,chanavg,'avg-'+mytargets[i]+'split.ms') for i in range(0,len(mytargets))],ncpu)
+                if mysplitfiles:
+                        splitavgfilename = mysplitfiles[-1]
+        else:
+                mysplitfiles = myparmap(mysplitinit,[(msfilename,mytargets[i],gainspw1,1,mytargets[i]+'split.ms') for i in range(0,len(mytargets))],ncpu)
+# with no target fields nothing is split and the configured splitfilename is kept
+        if mysplitfiles:
+                splitfilename = mysplitfiles[-1]
 #############################################################
 # Flagging on split file
 #############################################################
 
 if flagsplitfile == True:
-        try:
-                assert os.path.isdir(splitfilename), "flagsplitfile = True but the split file not found."
-        except AssertionError:
-                logging.info("flagsplitfile = True but the split file not found.")
-                sys.exit()
+        myrequire(splitfilename, "flagsplitfile = True but the split file not found.")
         logging.info("Now proceeding to flag on the split file.")
         myantselect =''
-        mytfcrop(splitfilename,'',myantselect,8.0,8.0,'DATA','')
         a, b = getbllists(splitfilename)
-        tdev = 6.0
-        fdev = 6.0
-        myrflag(splitfilename,'',a[0],tdev,fdev,'DATA','')
-        tdev = 5.0
-        fdev = 5.0
-        myrflag(splitfilename,'',b[0],tdev,fdev,'DATA','')
-        logging.info("A flagging summary is provided for the MS file.")
-        flagsummary(splitfilename)
+# tfcrop on all baselines, then rflag at 6 sigma on the C-C baselines and 5 sigma on the rest
+        mytfcroprflag(splitfilename,'',myantselect,8.0,8.0,[a[0],b[0]],[6.0,5.0],[6.0,5.0],'DATA','')
+        if verbose_flagsummary == True:
+                logging.info("A flagging summary is provided for the MS file.")
+                flagsummary(splitfilename)
 #############################################################
 # SPLIT AVERAGE
 #############################################################
-if dosplitavg == True:
-        try:
-                assert os.path.isdir(splitfilename), "dosplitavg = True but the split file not found."
-        except AssertionError:
-                logging.info("dosplitavg = True but the split file not found.")
-                sys.exit()
+if dosplitavg == True and splitwithavg == False:
+        myrequire(splitfilename, "dosplitavg = True but the split file not found.")
         logging.info("Your data will be averaged in frequency.")
-        if os.path.isdir('avg-'+splitfilename) == True:
-                os.system('rm -rf avg-'+splitfilename)
-                if os.path.isdir('avg-'+splitfilename+'.flagversions') == True:
-                        os.system('rm -rf avg-'+splitfilename+'.flagversions')
+        myrm('avg-'+splitfilename, 'avg-'+splitfilename+'.flagversions')
         splitavgfilename = mysplitavg(splitfilename,'','',chanavg,'avg-'+splitfilename)
 
 
 if doflagavg == True:
-        try:
-                assert os.path.isdir(splitavgfilename), "doflagavg = True but the splitavg file not found."
-        except AssertionError:
-                logging.info("doflagavg = True but the splitavg file not found.")
-                sys.exit()
+        myrequire(splitavgfilename, "doflagavg = True but the splitavg file not found.")
         logging.info("Flagging on freqeuncy averaged data.")
         a, b = getbllists(splitavgfilename)
-        myrflagavg(splitavgfilename,'',b[0],6.0,6.0,'DATA','')
-        myrflagavg(splitavgfilename,'',a[0],6.0,6.0,'DATA','')
-        logging.info("A flagging summary is provided for the MS file.")
-        flagsummary(splitavgfilename)
+        myrflagavglist(splitavgfilename,'',[b[0],a[0]],6.0,6.0,'DATA','')
+        if verbose_flagsummary == True:
+                logging.info("A flagging summary is provided for the MS file.")
+                flagsummary(splitavgfilename)
 
 ############################################################
 
 if makedirty == True:
-        try:
-                assert os.path.isdir(splitavgfilename), "makedirty = True but the splitavg file not found."
-        except AssertionError:
-                logging.info("makedirty = True but the splitavg file not found.")
-                sys.exit()
+        myrequire(splitavgfilename, "makedirty = True but the splitavg file not found.")
         myfile2 = splitavgfilename
-        logging.info("A flagging summary is provided for the MS file.")
-        flagsummary(splitavgfilename)
+        if verbose_flagsummary == True:
+                logging.info("A flagging summary is provided for the MS file.")
+                flagsummary(splitavgfilename)
         mytclean(myfile2,0,mJythreshold,0,imcellsize,imsize_pix,use_nterms,nwprojpl,clean_robust)
 
-if doselfcal == True:
-        if dosubbandselfcal == True:
-                try:
-                        assert os.path.isdir(splitavgfilename), "dosubbandselfcal = True but the splitavg file not found."                        
-                except AssertionError:
-                        logging.info("dosubbandselfcal = True but the splitavg file not found.")
-                        sys.exit()
-                nspws = getspws(splitavgfilename)
-                print(nspws)
-                logging.info(nspws)
-                if nspws == 1:
-                        mygainspw, msspw = makesubbands(splitavgfilename,subbandchan) 
-                        bw=getbw(splitavgfilename)
-                        logging.info("Bandwidth is %s",str(bw))
+# with imaging_tmpdir set (for example /dev/shm), tclean writes the selfcal images to a directory there and they are moved out after each export
+selfcaltmpdir = ''
+if doselfcal == True and imaging_tmpdir != '':
+        try:
+                selfcaltmpdir = tempfile.mkdtemp(prefix='capture_selfcal_', dir=imaging_tmpdir)
+        except OSError:
+                selfcaltmpdir = tempfile.mkdtemp(prefix='capture_selfcal_')
+        logging.info("The selfcal images are made in %s", selfcaltmpdir)
+
+# the scratch directory is removed even when selfcal stops early with an error or an exit
+try:
+        if doselfcal == True:
+                if dosubbandselfcal == True:
+                        myrequire(splitavgfilename, "dosubbandselfcal = True but the splitavg file not found.")
+                        nspws = getspws(splitavgfilename)
+                        print(nspws)
+                        logging.info('%s', nspws)
+                        if nspws == 1:
+                                mygainspw, msspw = makesubbands(splitavgfilename,subbandchan,ncpu) 
+                                bw=getbw(splitavgfilename)
+                                logging.info("Bandwidth is %s", bw)
 #if bw<=32E06:
 #raise Exception("GSB files cannot be subbanded. Make dosubbandselfcal False")
-                elif nspws > 1:
-                        msspw = list(range(0,nspws))
-                        print(msspw)
-                casalog.filter('INFO')
-                logging.info("A flagging summary is provided for the MS file.")
-                flagsummary(splitavgfilename)
-                clearcal(vis = splitavgfilename)
-                myfile2 = [splitavgfilename]
-                if usetclean == True:
-                        mysubbandselfcal(myfile2,subbandchan,ref_ant,scaloops,pcaloops,mJythreshold,imcellsize,imsize_pix,use_nterms,nwprojpl,scalsolints,clipresid,"","",False,niter_start,msspw,clean_robust)
-        else:
-                try:
-                        assert os.path.isdir(splitavgfilename), "doselfcal = True but the splitavg file not found."
-                except AssertionError:
-                        logging.info("doselfcal = True but the splitavg file not found.")
-                        sys.exit()
-                casalog.filter('INFO')
-                logging.info("A flagging summary is provided for the MS file.")
-                flagsummary(splitavgfilename)
-                clearcal(vis = splitavgfilename)
-                myfile2 = [splitavgfilename]
-                if usetclean == True:
-                        myselfcal(myfile2,ref_ant,scaloops,pcaloops,mJythreshold,imcellsize,imsize_pix,use_nterms,nwprojpl,scalsolints,clipresid,"","",False,niter_start,clean_robust)
+                        elif nspws > 1:
+                                msspw = list(range(0,nspws))
+                                print(msspw)
+                        casalog.filter('INFO')
+                        clearcal(vis = splitavgfilename)
+                        myfile2 = [splitavgfilename]
+                        if usetclean == True:
+                                mysubbandselfcal(myfile2,subbandchan,ref_ant,scaloops,pcaloops,mJythreshold,imcellsize,imsize_pix,use_nterms,nwprojpl,scalsolints,clipresid,"","",False,niter_start,msspw,clean_robust,convtol=selfcal_convtol,niterend=niter_end,tmpdir=selfcaltmpdir)
+                else:
+                        myrequire(splitavgfilename, "doselfcal = True but the splitavg file not found.")
+                        casalog.filter('INFO')
+                        clearcal(vis = splitavgfilename)
+                        myfile2 = [splitavgfilename]
+                        if usetclean == True:
+                                myselfcal(myfile2,ref_ant,scaloops,pcaloops,mJythreshold,imcellsize,imsize_pix,use_nterms,nwprojpl,scalsolints,clipresid,"","",False,niter_start,clean_robust,convtol=selfcal_convtol,niterend=niter_end,tmpdir=selfcaltmpdir)
+finally:
+        if selfcaltmpdir != '':
+                myrm(selfcaltmpdir)
@@ -8,18 +8,129 @@ def vislistobs(msfile):
         ms.open(msfile)  
         outr=ms.summary(verbose=True,listfile=msfile+'.list')
 #        print("A file containing listobs output is saved.")
-        try:
-                assert os.path.isfile(msfile+'.list'),logging.info("A file containing listobs output is saved.")
-        except AssertionError:
+        if os.path.isfile(msfile+'.list'):
+                logging.info("A file containing listobs output is saved.")
+        else:
                 logging.info("The listobs output as not saved in a .list file. Please check the CASA log.")
         return outr
 
-def getpols(msfile):
-        '''Get the number of polarizations in the file'''
+def myrmtree(mypath,nthreads=4):
+        '''Deletes the directory mypath, removing its top level subdirectories (the tables of an MS) on nthreads threads.'''
+        mysubdirs = [x.path for x in os.scandir(mypath) if x.is_dir(follow_symlinks=False)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as pool:
+                list(pool.map(lambda x: shutil.rmtree(x, ignore_errors=True), mysubdirs))
+        shutil.rmtree(mypath, ignore_errors=True)
+
+def myrm(*mypaths):
+        '''Deletes each of the given files or directories, such as an MS and its .flagversions, if it exists.'''
+        for mypath in mypaths:
+# a symbolic link is removed on its own, the data it points to is left alone
+                if os.path.islink(mypath):
+                        os.remove(mypath)
+                elif os.path.isdir(mypath):
+                        myrmtree(mypath)
+                elif os.path.isfile(mypath):
+                        os.remove(mypath)
+
+def myisnewer(myoutput,myinputs):
+        '''Returns True if myoutput exists and is at least as new as all the existing paths in myinputs.'''
+        if not os.path.exists(myoutput):
+                return False
+        mytime = os.path.getmtime(myoutput)
+        for myinput in myinputs:
+                if os.path.exists(myinput) and os.path.getmtime(myinput) > mytime:
+                        return False
+        return True
+
+def myrequire(mypath,mymessage):
+        '''Logs mymessage and stops the pipeline if the MS mypath needed by a step is not found.'''
+        if not os.path.isdir(mypath):
+                logging.info(mymessage)
+                sys.exit()
+
+def mychecktables(mytables):
+        '''Stops the pipeline if any of the caltables is missing or has no solutions, before applycal reads the whole MS.'''
+        for mytable in mytables:
+                if not os.path.isdir(mytable):
+                        logging.info("The caltable %s was not found.", mytable)
+                        sys.exit()
+                tb.open(mytable)
+                mynrows = tb.nrows()
+                tb.close()
+                if mynrows == 0:
+                        logging.info("The caltable %s has no solutions.", mytable)
+                        sys.exit()
+
+# tclean images in parallel only when CAPTURE_PARALLEL=1 is set and the pipeline is started with mpicasa.
+# The split files are then also written as Multi-MS, so that flagging and self-calibration on them run in parallel too.
+useparallel = (os.environ.get('CAPTURE_PARALLEL','0') == '1' and 'OMPI_COMM_WORLD_SIZE' in os.environ)
+
+msinfocache = {}
+
+def loadmsinfo(msfile,mtime):
+        '''Reads the metadata saved by an earlier run from the json file next to the ms. Returns None if it is missing or the ms has changed since.'''
+        metafile = msfile+'.capture_meta.json'
+        if not os.path.exists(metafile):
+                return None
+        try:
+                with open(metafile) as f:
+                        msinfo = json.load(f)
+        except (OSError, ValueError):
+                return None
+# files written before nspw was cached are read again
+        if msinfo.get('mtime') != mtime or 'nspw' not in msinfo:
+                return None
+        msinfo['freqs'] = np.asarray(msinfo['freqs'])
+        msinfo['antsbyscan'] = {int(x): msinfo['antsbyscan'][x] for x in msinfo['antsbyscan']}
+        return msinfo
+
+def savemsinfo(msfile,msinfo):
+        '''Saves the metadata next to the ms so that a re-run does not have to open it again.'''
+        metadata = dict(msinfo)
+        metadata['freqs'] = np.asarray(msinfo['freqs']).tolist()
+        metadata['fields'] = list(msinfo['fields'])
+        metadata['npol'] = int(msinfo['npol'])
+        metadata['nchan'] = int(msinfo['nchan'])
+        metadata['bw'] = float(msinfo['bw'])
+        metadata['nspw'] = int(msinfo['nspw'])
+        try:
+                with open(msfile+'.capture_meta.json', 'w') as f:
+                        json.dump(metadata, f)
+        except OSError:
+                logging.info("Could not write the metadata file for "+msfile)
+
+def getmsinfo(msfile):
+        '''Reads the metadata used by the pipeline with a single msmd open. The result is reused until the ms changes on disk.'''
+        mtime = os.path.getmtime(msfile+'/table.dat')
+        if msfile in msinfocache and msinfocache[msfile]['mtime'] == mtime:
+                return msinfocache[msfile]
+        msinfo = loadmsinfo(msfile,mtime)
+        if msinfo != None:
+                msinfocache[msfile] = msinfo
+                return msinfo
         msmd.open(msfile)
-        polid = msmd.ncorrforpol(0)
+        fieldnames = msmd.fieldnames()
+        fieldscans = msmd.scansforfields()
+        msinfo = {'mtime': mtime, 'fields': fieldnames, 'npol': msmd.ncorrforpol(0), 'nchan': msmd.nchan(0), 'freqs': msmd.chanfreqs(0), 'bw': msmd.bandwidths(0), 'nspw': msmd.nspw()}
+        antnames = msmd.antennanames()
+        antsbyscan = {}
+        for scanno in msmd.scannumbers():
+                antsbyscan[int(scanno)] = [antnames[x] for x in msmd.antennasforscan(int(scanno))]
         msmd.done()
-        return polid
+        msinfo['antsbyscan'] = antsbyscan
+        scansbyfield = {}
+        for fieldid in fieldscans.keys():
+                scansbyfield.setdefault(fieldnames[int(fieldid)], set()).update(fieldscans[fieldid].tolist())
+        for fieldname in scansbyfield.keys():
+                scansbyfield[fieldname] = sorted(scansbyfield[fieldname])
+        msinfo['scansbyfield'] = scansbyfield
+        msinfocache[msfile] = msinfo
+        savemsinfo(msfile,msinfo)
+        return msinfo
+
+def getpols(msfile):
+        '''Get the number of polarizations in the file'''
+        return getmsinfo(msfile)['npol']
 
 def mypols(inpvis,mypolid):
     msmd.open(inpvis)
@@ -30,98 +141,77 @@ def mypols(inpvis,mypolid):
 
 def getfields(msfile):
         '''get list of field names in the ms'''
-        msmd.open(msfile)  
-        fieldnames = msmd.fieldnames()
-        msmd.done()
-        return fieldnames
+        return list(getmsinfo(msfile)['fields'])
 
 def getscans(msfile, mysrc):
         '''get a list of scan numbers for the specified source'''
-        msmd.open(msfile)
-        myscan_numbers = msmd.scansforfield(mysrc)
-        myscanlist = myscan_numbers.tolist()
-        msmd.done()
-        return myscanlist
+        return list(getmsinfo(msfile)['scansbyfield'].get(mysrc,[]))
+
+def getscansbyfield(msfile):
+        '''get a dictionary of scan numbers for every field name in the ms'''
+        scansbyfield = getmsinfo(msfile)['scansbyfield']
+        return {x: list(scansbyfield[x]) for x in scansbyfield.keys()}
 
 def getantlist(myvis,scanno):
-        msmd.open(myvis)
-        antenna_name = msmd.antennasforscan(scanno)
-        antlist=[]
-        for i in range(0,len(antenna_name)):
-                antlist.append(msmd.antennanames(antenna_name[i])[0])
-        return antlist
+        '''get the names of the antennas in the specified scan'''
+        return list(getmsinfo(myvis)['antsbyscan'][int(scanno)])
 
 
 def getnchan(msfile):
-        msmd.open(msfile)
-        nchan = msmd.nchan(0)
-        msmd.done()
-        return nchan
+        return getmsinfo(msfile)['nchan']
 
 def getbw(msfile):
-        msmd.open(msfile)
-        bw = msmd.bandwidths(0)
-        msmd.done()
-        return bw
+        return getmsinfo(msfile)['bw']
 
 
 def freq_info(ms_file):                                                                        
-        sw = 0
-        msmd.open(ms_file)
-        freq=msmd.chanfreqs(sw)                                                                
-        msmd.done()
-        return freq                                                                        
+        return getmsinfo(ms_file)['freqs'].copy()
 
 def makebl(ant1,ant2):
         mybl = ant1+'&'+ant2
         return mybl
 
 
+bllistcache = {}
+
 def getbllists(myfile):
+        '''Returns the C-C baselines and the remaining baselines as flagdata antenna strings. The lists are kept per ms and rebuilt only if the ms changes on disk.'''
+        mtime = os.path.getmtime(myfile+'/table.dat')
+        if myfile in bllistcache and bllistcache[myfile][0] == mtime:
+                return list(bllistcache[myfile][1]), list(bllistcache[myfile][2])
         myfields = getfields(myfile)
         myallscans =[]
         for i in range(0,len(myfields)):
                 myallscans.extend(getscans(myfile, myfields[i]))
-        myantlist = getantlist(myfile,int(myallscans[0]))
-        allbl=[]
-        for i in range(0,len(myantlist)):
-                for j in range(0,len(myantlist)):
-                        if j>i:
-                                allbl.append(makebl(myantlist[i],myantlist[j]))
-        mycc=[]
-        mycaa=[]
-        for i in range(0,len(allbl)):
-                if allbl[i].count('C')==2:
-                        mycc.append(allbl[i])
-                else:
-                        mycaa.append(allbl[i])
+        myantlist = np.array(getantlist(myfile,int(myallscans[0])))
+# all the baselines i<j in one go, in the same order as a double loop over the antennas
+        i, j = np.triu_indices(len(myantlist), k=1)
+        allbl = np.char.add(np.char.add(myantlist[i],'&'),myantlist[j])
+        iscc = np.char.startswith(myantlist[i],'C') & np.char.startswith(myantlist[j],'C')
         myshortbl =[]
-        myshortbl.append(str('; '.join(mycc)))
+        myshortbl.append('; '.join(allbl[iscc].tolist()))
         mylongbl =[]
-        mylongbl.append(str('; '.join(mycaa)))
-        return myshortbl, mylongbl
-
-
-def getbandcut(inpmsfile):
-        cutoffs = {'L':0.2, 'P':0.3, '235':0.5, '610':0.2, 'b4':0.2, 'b2':0.7, '150':0.7}
-        frange = freq_info(inpmsfile)
-        fmin = min(frange)
-        fmax = max(frange)
-        if fmin > 1000E06:
-                fband = 'L'
-        elif fmin >500E06 and fmin < 1000E06:
-                fband = 'b4'
-        elif fmin >260E06 and fmin < 560E06:
-                fband = 'P'
-        elif fmin > 210E06 and fmin < 260E06:
-                fband = '235'
-        elif fmin > 80E6 and fmin < 200E6:
-                fband = 'b2'
-        else:
-                "Frequency band does not match any of the GMRT bands."
+        mylongbl.append('; '.join(allbl[~iscc].tolist()))
+        bllistcache[myfile] = (mtime, myshortbl, mylongbl)
+        return list(myshortbl), list(mylongbl)
+
+
+# GMRT bands by the lowest frequency in the file: np.searchsorted on bandedges gives the index into bandnames
+bandedges = np.array([80E6, 200E6, 210E6, 260E6, 500E6, 1000E6])
+bandnames = [None, 'b2', None, '235', 'P', 'b4', 'L']
+bandcutoffs = {'L':0.2, 'P':0.3, '235':0.5, '610':0.2, 'b4':0.2, 'b2':0.7, '150':0.7}
+
+def getbandcut(inpmsfile,frange=None):
+        '''Returns the mean amplitude cutoff for bad antennas in the band of the file. frange can be passed in if the channel frequencies are already known.'''
+        if frange is None:
+                frange = freq_info(inpmsfile)
+        fmin = float(min(frange[0], frange[-1]))
+        fband = bandnames[int(np.searchsorted(bandedges, fmin))]
+        if fband == None:
+                logging.info("Frequency band does not match any of the GMRT bands.")
         logging.info("The frequency band in the file is ")
         logging.info(fband)
-        xcut = cutoffs.get(fband)
+        xcut = bandcutoffs.get(fband)
         logging.info("The mean cutoff used for flagging bad antennas is ")
         logging.info(xcut)
         return xcut
@@ -146,50 +236,78 @@ def myvisstatampraw(myfile,myspw,myant,mycorr,myscan):
         mymean1 = mystat['DATA_DESC_ID=0']['mean']
         return mymean1
 
-
-def mygaincal_ap1(myfile,mycal,myref,myflagspw,myuvracal,calsuffix):
-        default(gaincal)
-        gtable = [str(myfile)+'.K1', str(myfile)+'.B1' ]
-        gaincal(vis=myfile, caltable=str(myfile)+'.AP.G', spw =myflagspw,uvrange=myuvracal,append=True,
-                field=mycal,solint = '120s',refant = myref, minsnr = 2.0, solmode ='L1R', gaintype = 'G', calmode = 'ap',
-                gaintable = gtable, interp = ['nearest,nearestflag', 'nearest,nearestflag' ], parang = True )
-        return gtable
-
-
-def mygaincal_ap2(myfile,mycal,myref,myflagspw,myuvracal,calsuffix,appflag):
+def myparmap(myfunc,myargs,nproc):
+        '''Runs myfunc on each argument tuple in myargs using nproc forked workers and returns the results in order.
+        An exception or exit in a worker is raised again here, and a worker that dies without a result stops the run.
+        The workers are forked from a process in which the casa tools and the casa logger are already running, so myfunc
+        must be pure python or a casa task that opens its own tables (visstat, mstransform). It must not use a tool
+        (msmd, tb, ms) left open by the caller, and no table may be open in the caller while myparmap runs.'''
+# a process holding the mpi communicator of mpicasa must not be forked, so under mpicasa the calls run one after another
+        if nproc <= 1 or len(myargs) <= 1 or 'OMPI_COMM_WORLD_SIZE' in os.environ:
+                return [myfunc(*x) for x in myargs]
+        nproc = min(nproc,len(myargs))
+        ctx = multiprocessing.get_context('fork')
+# log records still buffered in the parent would otherwise be written again by every worker
+        for myhandler in logging.getLogger().handlers:
+                myhandler.flush()
+        myqueue = ctx.Queue()
+        def myworker(wid):
+                for k in range(wid,len(myargs),nproc):
+                        try:
+                                myresult = myfunc(*myargs[k])
+# the result is pickled here, so that one which cannot be sent back fails in the worker instead of being lost
+                                pickle.dumps(myresult)
+                        except BaseException as e:
+                                try:
+                                        pickle.dumps(e)
+                                        myresult = e
+                                except Exception:
+                                        myresult = RuntimeError(repr(e))
+                        myqueue.put((k,myresult))
+        workers = [ctx.Process(target=myworker,args=(wid,)) for wid in range(nproc)]
+        for w in workers:
+                w.start()
+        results = [None]*len(myargs)
+        ndone = 0
+        while ndone < len(myargs):
+                try:
+                        k, result = myqueue.get(timeout=10)
+                except queue.Empty:
+                        mydead = [w for w in workers if w.exitcode not in (None, 0)]
+                        if len(mydead) > 0 or not any([w.is_alive() for w in workers]):
+                                for w in workers:
+                                        if w.is_alive():
+                                                w.terminate()
+                                        w.join()
+                                raise RuntimeError("A worker of myparmap running "+myfunc.__name__+" died before returning all its results.")
+                        continue
+                results[k] = result
+                ndone = ndone+1
+        for w in workers:
+                w.join()
+        for result in results:
+                if isinstance(result,BaseException):
+                        raise result
+        return results
+
+
+def mygaincal_ap2(myfile,mycal,myref,myflagspw,myuvracal,calsuffix='',appflag=False):
+        '''amplitude and phase gaincal on the calibrators into myfile.AP.G<calsuffix>, after the K1 and B1 tables with the same suffix'''
         default(gaincal)
-        gtable = [str(myfile)+'.K1'+calsuffix, str(myfile)+'.B1'+calsuffix ]
-        gaincal(vis=myfile, caltable=str(myfile)+'.AP.G'+calsuffix, spw =myflagspw,uvrange=myuvracal,append=appflag,
+        gtable = [myfile+'.K1'+calsuffix, myfile+'.B1'+calsuffix ]
+        gaincal(vis=myfile, caltable=myfile+'.AP.G'+calsuffix, spw =myflagspw,uvrange=myuvracal,append=appflag,
                 field=mycal,solint = '120s',refant = myref, minsnr = 2.0, solmode ='L1R', gaintype = 'G', calmode = 'ap',
                 gaintable = gtable, interp = ['nearest,nearestflag', 'nearest,nearestflag' ], parang = True )
         return gtable
 
-def getfluxcal(myfile,mycalref,myscal):
-        myscale = fluxscale(vis=myfile, caltable=str(myfile)+'.AP.G', fluxtable=str(myfile)+'.fluxscale', reference=mycalref, transfer=myscal,
-                    incremental=False)
-        return myscale
-
 
-def getfluxcal2(myfile,mycalref,myscal,calsuffix):
-        myscale = fluxscale(vis=myfile, caltable=str(myfile)+'.AP.G'+calsuffix, fluxtable=str(myfile)+'.fluxscale'+calsuffix, reference=mycalref,
+def getfluxcal2(myfile,mycalref,myscal,calsuffix=''):
+        '''fluxscale from myfile.AP.G<calsuffix> into myfile.fluxscale<calsuffix>'''
+        myscale = fluxscale(vis=myfile, caltable=myfile+'.AP.G'+calsuffix, fluxtable=myfile+'.fluxscale'+calsuffix, reference=mycalref,
                     transfer=myscal, incremental=False)
         return myscale
 
 
-
-def mygaincal_ap_redo(myfile,mycal,myref,myflagspw,myuvracal):
-        default(gaincal)
-        gtable = [str(myfile)+'.K1'+'recal', str(myfile)+'.B1'+'recal' ]
-        gaincal(vis=myfile, caltable=str(myfile)+'.AP.G.'+'recal', append=True, spw =myflagspw, uvrange=myuvracal,
-                field=mycal,solint = '120s',refant = myref, minsnr = 2.0,solmode ='L1R', gaintype = 'G', calmode = 'ap',
-                gaintable = gtable, interp = ['nearest,nearestflag', 'nearest,nearestflag' ], parang = True )
-        return gtable
-
-def getfluxcal_redo(myfile,mycalref,myscal):
-        myscale = fluxscale(vis=myfile, caltable=str(myfile)+'.AP.G'+'recal', fluxtable=str(myfile)+'.fluxscale'+'recal', reference=mycalref,
-                    transfer=myscal, incremental=False)
-        return myscale
-
 def mytfcrop(myfile,myfield,myants,tcut,fcut,mydatcol,myflagspw):
         default(flagdata)
         flagdata(vis=myfile, antenna = myants, field = myfield,        spw = myflagspw, mode='tfcrop', ntime='300s', combinescans=False,
@@ -206,6 +324,16 @@ def myrflag(myfile,myfield, myants, mytimdev, myfdev,mydatcol,myflagspw):
         return
 
 
+def mytfcroprflag(myfile,myfield,mytfants,tcut,fcut,myrflagants,mytimdevs,myfdevs,mydatcol,myflagspw):
+        '''tfcrop on mytfants followed by rflag on each of myrflagants, done in one pass over the data with flagdata in list mode'''
+        myflgcmds = ["mode='tfcrop' field='%s' spw='%s' antenna='%s' datacolumn='%s' ntime='300s' combinescans=False timecutoff=%s freqcutoff=%s timefit='line' freqfit='line' flagdimension='freqtime' usewindowstats='sum' extendflags=False" % (myfield, myflagspw, mytfants, mydatcol, tcut, fcut)]
+        for i in range(0,len(myrflagants)):
+                myflgcmds.append("mode='rflag' field='%s' spw='%s' antenna='%s' datacolumn='%s' ntime='scan' combinescans=False winsize=3 timedevscale=%s freqdevscale=%s spectralmax=1000000.0 spectralmin=0.0 extendflags=False" % (myfield, myflagspw, myrflagants[i], mydatcol, mytimdevs[i], myfdevs[i]))
+        default(flagdata)
+        flagdata(vis=myfile, mode='list', inpfile=myflgcmds, action='apply', flagbackup=True)
+        return
+
+
 def myrflagavg(myfile,myfield, myants, mytimdev, myfdev,mydatcol,myflagspw):
         default(flagdata)
         flagdata(vis=myfile, field = myfield, spw = myflagspw, antenna = myants, mode='rflag', ntime='300s', combinescans=True,
@@ -214,125 +342,83 @@ def myrflagavg(myfile,myfield, myants, mytimdev, myfdev,mydatcol,myflagspw):
                 channelavg=False, timeavg=False, action='apply', display='none')
         return
 
-def getgainspw(msfilename):
-        mynchan = getnchan(msfilename)
+
+def myrflagavglist(myfile,myfield,myantslist,mytimdev,myfdev,mydatcol,myflagspw):
+        '''myrflagavg on each antenna selection in myantslist, done in one pass over the data with flagdata in list mode'''
+        myflgcmds = []
+        for myants in myantslist:
+                myflgcmds.append("mode='rflag' field='%s' spw='%s' antenna='%s' datacolumn='%s' ntime='300s' combinescans=True winsize=3 timedevscale=%s freqdevscale=%s spectralmax=1000000.0 spectralmin=0.0 extendflags=False" % (myfield, myflagspw, myants, mydatcol, mytimdev, myfdev))
+        default(flagdata)
+        flagdata(vis=myfile, mode='list', inpfile=myflgcmds, action='apply', flagbackup=True)
+        return
+
+
+# Channel ranges by (number of channels, band): (good channels used for visstat, channels for flagging, channels for calibration).
+# The band is 'b2' for band-2, '235' and '610' for the single polarization dual frequency data of the legacy GMRT, and None otherwise.
+gainspwtable = {
+        (2048, 'b2'): ('0:700~800;1500~1600', '0:500~1650;1350~1800', '0:571~1130;1391~1750'),
+        (4096, 'b2'): ('0:1400~1600;3000~3200', '0:1000~2300;2700~3600', '0:1151~2250;2801~3500'),
+        (128, None): ('0:50~70', '0:5~115', '0:11~115'),
+        (256, '235'): ('0:150~160', '0:70~220', '0:91~190'),
+        (256, '610'): ('0:100~120', '0:11~240', '0:21~230'),
+        (256, None): ('0:150~160', '0:11~240', '0:21~230'),
+        (512, None): ('0:200~240', '0:21~500', '0:41~490'),
+        (1024, None): ('0:250~300', '0:51~950', '0:101~900'),
+        (2048, None): ('0:500~600', '0:101~1900', '0:201~1800'),
+        (4096, None): ('0:1000~1200', '0:41~4050', '0:201~3600'),
+        (8192, None): ('0:2000~3000', '0:500~7800', '0:1000~7000'),
+        (16384, None): ('0:4000~6000', '0:1000~14500', '0:2000~13500')}
+
+def getgainspw(msfilename,frange=None,nchan=None):
+        '''Returns the channel ranges for calibration, visstat and flagging, the number of polarizations and the single polarization product (RR/LL, empty for dual pol data).
+        frange and nchan can be passed in if the channel frequencies and the number of channels are already known.'''
+        if nchan is None:
+                nchan = getnchan(msfilename)
+        if frange is None:
+                frange = freq_info(msfilename)
+        mynchan = nchan
         logging.info('The number of channels in your file %d',mynchan)
-        gmrt235 = False
-        gmrt610 = False
-        gmrtfreq = 0.0
+        fmin = float(min(frange[0], frange[-1]))
+        fband = None
+        poldata = ''
 # check if single pol data
         mypol = getpols(msfilename)
-#        logging.info('Your file contains %s polarization products.', mypol)
         if mypol == 1:
-#                print("This dataset contains only single polarization data.")
                 logging.info('This dataset contains only single polarization data.')
-                mychnu = freq_info(msfilename)
-                if 200E6< mychnu[0]<300E6:
+                if 200E6< frange[0]<300E6:
                         poldata = 'LL'
-                        gmrt235 = True
-                        gmrt610 = False
-                        mynchan = getnchan(msfilename)
+                        fband = '235'
                         if mynchan !=256:
-#                                print("You have data in the 235 MHz band of dual frequency mode of the GMRT. Currently files only with 256 channels are supported in this pipeline.")
                                 logging.info('You have data in the 235 MHz band of dual frequency mode of the GMRT. Currently files only with 256 channels are supported in this pipeline.')
                                 sys.exit()
-                elif 590E6<mychnu[0]<700E6:
+                elif 590E6<frange[0]<700E6:
                         poldata = 'RR'
-                        gmrt235 = False
-                        gmrt610 = True
-                        mynchan = getnchan(msfilename)
+                        fband = '610'
                         if mynchan != 256:
-#                                print("You have data in the 610 MHz band of the dual frequency mode of the legacy GMRT. Currently files only with 256 channels are supported in this pipeline.")
                                 logging.info('You have data in the 610 MHz band of the dual frequency mode of the legacy GMRT. Currently files only with 256 channels are supported in this pipeline.')
                                 sys.exit()
                 else:
-                        gmrtfreq = mychnu[0]
-#                        print("You have data in a single polarization - most likely GMRT hardware correlator. This pipeline currently does not support reduction of single pol HW correlator data.")
                         logging.info('You have data in a single polarization - most likely GMRT hardware correlator. This pipeline currently does not support reduction of single pol HW correlator data.')
-#                        print("The number of channels in this file are %d" %  mychnu[0])
-                        logging.info('The number of channels in this file are %d', mychnu[0])
-                        sys.exit()
+                        logging.info('The number of channels in this file are %d', mynchan)
                         sys.exit()
-        frange = freq_info(msfilename)
-        fmin = min(frange)
-        fmax = max(frange)
-        if fmin > 80E6 and fmin < 200E6:
+        if bandnames[int(np.searchsorted(bandedges, fmin))] == 'b2':
+                fband = 'b2'
                 logging.info("Your observations are at band-2. This pipeline is not well tested for this band yet. Currently only total channel numbers of 2048 and 4096 are supported.")
-                if mynchan == 2048:
-                        mygoodchans = '0:700~800;1500~1600'
-                        flagspw = '0:500~1650;1350~1800'
-                        gainspw ='0:571~1130;1391~1750'
-                        gainspw2 ='0:571~1130;1391~1750'                        
-                elif mynchan == 4096:
-                        mygoodchans = '0:1400~1600;3000~3200'
-                        flagspw = '0:1000~2300;2700~3600'
-                        gainspw ='0:1151~2250;2801~3500'
-                        gainspw2 ='0:1151~2250;2801~3500'                        
+        if (mynchan, fband) in gainspwtable:
+                mygoodchans, flagspw, gainspw = gainspwtable[(mynchan, fband)]
+        elif fband == None:
+# other channel numbers: drop 5% of the channels at each edge for flagging and 10% for calibration, and use the central 5% for visstat
+                logging.info('There are no preset channel ranges for %d channels, so they are computed from the band edges.', mynchan)
+                myedge = int(mynchan*0.05)
+                mygainedge = int(mynchan*0.10)
+                mygoodchans = '0:%d~%d' % (mynchan//2 - mynchan//40, mynchan//2 + mynchan//40)
+                flagspw = '0:%d~%d' % (myedge, mynchan-1-myedge)
+                gainspw = '0:%d~%d' % (mygainedge, mynchan-1-mygainedge)
         else:
-# Now get the channel range.        
-                if mynchan == 1024:
-                        mygoodchans = '0:250~300'   # used for visstat
-                        flagspw = '0:51~950'
-                        gainspw = '0:101~900'
-                        gainspw2 = ''   # central good channels after split file for self-cal
-                        logging.info("The following channel range will be used.")
-                elif mynchan == 2048:
-                        mygoodchans = '0:500~600'   # used for visstat
-                        flagspw = '0:101~1900'
-                        gainspw = '0:201~1800'
-                        gainspw2 = ''   # central good channels after split file for self-cal
-                        logging.info("The following channel range will be used.")
-                elif mynchan == 4096:
-                        mygoodchans = '0:1000~1200'
-                        flagspw = '0:41~4050'
-                        gainspw = '0:201~3600'
-                        gainspw2 = ''   # central good channels after split file for self-cal
-                        logging.info("The following channel range will be used.")
-                elif mynchan == 8192:
-                        mygoodchans = '0:2000~3000'
-                        flagspw = '0:500~7800'
-                        gainspw = '0:1000~7000'
-                        gainspw2 = ''   # central good channels after split file for self-cal
-                        logging.info("The following channel range will be used.")
-                elif mynchan == 16384:
-                        mygoodchans = '0:4000~6000'
-                        flagspw = '0:1000~14500'
-                        gainspw = '0:2000~13500'
-                        gainspw2 = ''   # central good channels after split file for self-cal
-                        logging.info("The following channel range will be used.")
-                elif mynchan == 128:
-                        mygoodchans = '0:50~70'
-                        flagspw = '0:5~115'
-                        gainspw = '0:11~115'
-                        gainspw2 = ''   # central good channels after split file for self-cal
-                        logging.info("The following channel range will be used.")
-                elif mynchan == 256:
-#                        if poldata == 'LL':
-                        if gmrt235 == True:
-                                mygoodchans = '0:150~160'
-                                flagspw = '0:70~220'
-                                gainspw = '0:91~190'
-                                gainspw2 = ''   # central good channels after split file for self-cal
-                                logging.info("The following channel range will be used.")
-                        elif gmrt610 == True:
-                                mygoodchans = '0:100~120'
-                                flagspw = '0:11~240'
-                                gainspw = '0:21~230'
-                                gainspw2 = ''   # central good channels after split file for self-cal   
-                                logging.info("The following channel range will be used.")
-                        else:
-                                mygoodchans = '0:150~160'
-                                flagspw = '0:11~240'
-                                gainspw = '0:21~230'
-                                gainspw2 = ''   # central good channels after split file for self-cal
-                                logging.info("The following channel range will be used.")
-                elif mynchan == 512:
-                        mygoodchans = '0:200~240'
-                        flagspw = '0:21~500'
-                        gainspw = '0:41~490'
-                        gainspw2 = ''   # central good channels after split file for self-cal   
-                        logging.info("The following channel range will be used.")
-        return gainspw, mygoodchans, flagspw, mypol
+                logging.info('Files with %d channels are not supported in this pipeline.', mynchan)
+                sys.exit()
+        logging.info("The following channel range will be used.")
+        return gainspw, mygoodchans, flagspw, mypol, poldata
 
 
 
@@ -340,7 +426,7 @@ def mysplitinit(myfile,myfield,myspw,mywidth,split_filename):
         '''function to split corrected data for any field'''
         default(mstransform)
         #mstransform(vis=myfile, field=myfield, spw=myspw, chanaverage=False, chanbin=mywidth, datacolumn='corrected', outputvis=str(myfield)+'.split.ms')
-        mstransform(vis=myfile, field=myfield, spw=myspw, chanaverage=False, chanbin=mywidth, datacolumn='corrected', outputvis=split_filename)
+        mstransform(vis=myfile, field=myfield, spw=myspw, chanaverage=False, chanbin=mywidth, datacolumn='corrected', outputvis=split_filename, createmms=useparallel, separationaxis='auto')
         #myoutvis=str(myfield)+'.split.ms'
         #return myoutvis
         return split_filename
@@ -352,75 +438,57 @@ def mysplitavg(myfile,myfield,myspw,mywidth,split_avg_filename):
         #myoutname='avg-'+myfile
         default(mstransform)
         #mstransform(vis=myfile, field=myfield, spw=myspw, chanaverage=True, chanbin=mywidth, datacolumn='data', outputvis=myoutname)
-        mstransform(vis=myfile, field=myfield, spw=myspw, chanaverage=True, chanbin=mywidth, datacolumn='data', outputvis=split_avg_filename)
+        mstransform(vis=myfile, field=myfield, spw=myspw, chanaverage=True, chanbin=mywidth, datacolumn='data', outputvis=split_avg_filename, createmms=useparallel, separationaxis='auto')
         #return myoutname
         return split_avg_filename
 
 
-def mytclean(myfile,myniter,mythresh,srno,cell,imsize, mynterms1,mywproj,clean_robust):    # you may change the multi-scale inputs as per your field
-        nameprefix = getfields(myfile)[0]#myfile.split('.')[0]
-        print("The image files have the following prefix =",nameprefix)
+def mysplitinitavg(myfile,myfield,myspw,mywidth,split_avg_filename):
+        '''function to split and channel average the corrected data for any field in one pass'''
+        default(mstransform)
+        mstransform(vis=myfile, field=myfield, spw=myspw, chanaverage=True, chanbin=mywidth, datacolumn='corrected', outputvis=split_avg_filename, createmms=useparallel, separationaxis='auto')
+        return split_avg_filename
+
+
+def mytcleanname(nameprefix,myniter,srno):
+        '''Name of the image that mytclean makes'''
         if myniter==0:
-                myoutimg = nameprefix+'-dirty-img'
-        else:
-                myoutimg = nameprefix+'-selfcal'+'img'+str(srno)
-        default(tclean)
-        if mynterms1 > 1:
-                tclean(vis=myfile,
-                        imagename=myoutimg, selectdata= True, field='0', spw='', imsize=imsize, cell=cell, robust=clean_robust, weighting='briggs', 
-                        specmode='mfs',        nterms=mynterms1, niter=myniter, usemask='auto-multithresh',minbeamfrac=0.1, sidelobethreshold = 2.0,
-#                        minpsffraction=0.05,
-#                        maxpsffraction=0.8,
-                        smallscalebias=0.6, threshold= mythresh, aterm =True, pblimit=-0.001, pbmask=0.0,
-                        deconvolver='mtmfs', gridder='wproject', wprojplanes=mywproj, scales=[0,5,15],wbawp=False,
-                        restoration = True, savemodel='modelcolumn', cyclefactor = 0.5, parallel=False,
-                        interactive=False)
-        else:
-                tclean(vis=myfile,
-                        imagename=myoutimg, selectdata= True, field='0', spw='', imsize=imsize, cell=cell, robust=clean_robust, weighting='briggs', 
-                        specmode='mfs',        nterms=mynterms1, niter=myniter, usemask='auto-multithresh',minbeamfrac=0.1,sidelobethreshold = 2.0,
-#                        minpsffraction=0.05,
-#                        maxpsffraction=0.8,
-                        smallscalebias=0.6, threshold= mythresh, aterm =True, pblimit=-0.001, pbmask=0.0,
-                        deconvolver='multiscale', gridder='wproject', wprojplanes=mywproj, scales=[0,5,15],wbawp=False,
-                        restoration = True, savemodel='modelcolumn', cyclefactor = 0.5, parallel=False,
-                        interactive=False)
-        return myoutimg
+                return nameprefix+'-dirty-img'
+        return nameprefix+'-selfcal'+'img'+str(srno)
 
-def mysbtclean(myfile,myniter,mythresh,srno,cell,imsize, mynterms1,mywproj,clean_robust):    # you may change the multi-scale inputs as per your field
-        nameprefix = getfields(myfile)[0]#myfile.split('.')[0]
+def mytclean(myfile,myniter,mythresh,srno,cell,imsize, mynterms1,mywproj,clean_robust,nameprefix=None,skipifexists=False,parallel=None):    # you may change the multi-scale inputs as per your field
+        if nameprefix is None:
+                nameprefix = getfields(myfile)[0]#myfile.split('.')[0]
         print("The image files have the following prefix =",nameprefix)
-        if myniter==0:
-                myoutimg = nameprefix+'-dirty-img'
+        myoutimg = mytcleanname(nameprefix,myniter,srno)
+        if mynterms1 > 1:
+                mydeconvolver = 'mtmfs'
+                myimgext = '.image.tt0'
         else:
-                myoutimg = nameprefix+'-selfcal'+'img'+str(srno)
-        try:
-                assert os.path.isdir(myoutimg+'.image.tt0'), "The image file exists, imaging will not proceed."
-        except AssertionError:
-                logging.info("The image file does not exist, thus running tclean.")
-                default(tclean)
-                if mynterms1 > 1:
-                        tclean(vis=myfile,
-                                imagename=myoutimg, selectdata= True, field='0', spw='', imsize=imsize, cell=cell, robust=clean_robust, weighting='briggs', 
-                                specmode='mfs',        nterms=mynterms1, niter=myniter, usemask='auto-multithresh',minbeamfrac=0.1, sidelobethreshold = 2.0,
-#                        minpsffraction=0.05,
-#                        maxpsffraction=0.8,
-                                smallscalebias=0.6, threshold= mythresh, aterm =True, pblimit=-0.001, pbmask=0.0,
-                                deconvolver='mtmfs', gridder='wproject', wprojplanes=mywproj, scales=[0,5,15],wbawp=False,
-                                restoration = True, savemodel='modelcolumn', cyclefactor = 0.5, parallel=False,
-                                interactive=False)
-                else:
-                        tclean(vis=myfile,
-                                imagename=myoutimg, selectdata= True, field='0', spw='', imsize=imsize, cell=cell, robust=clean_robust, weighting='briggs', 
-                                specmode='mfs',        nterms=mynterms1, niter=myniter, usemask='auto-multithresh',minbeamfrac=0.1,sidelobethreshold = 2.0,
-#                        minpsffraction=0.05,
-#                        maxpsffraction=0.8,
-                                smallscalebias=0.6, threshold= mythresh, aterm =True, pblimit=-0.001, pbmask=0.0,
-                                deconvolver='multiscale', gridder='wproject', wprojplanes=mywproj, scales=[0,5,15],wbawp=False,
-                                restoration = True, savemodel='modelcolumn', cyclefactor = 0.5, parallel=False,
-                                interactive=False)
+                mydeconvolver = 'multiscale'
+                myimgext = '.image'
+# images made in a scratch directory are moved to the working directory afterwards, so that is where an existing one is found
+        if skipifexists == True and os.path.isdir(os.path.basename(myoutimg)+myimgext):
+                logging.info("The image file exists, imaging will not proceed.")
+                return os.path.basename(myoutimg)
+        if parallel is None:
+                parallel = useparallel
+        logging.info("Running tclean to make %s.", myoutimg)
+        default(tclean)
+        tclean(vis=myfile,
+                imagename=myoutimg, selectdata= True, field='0', spw='', imsize=imsize, cell=cell, robust=clean_robust, weighting='briggs', 
+                specmode='mfs',        nterms=mynterms1, niter=myniter, usemask='auto-multithresh',minbeamfrac=0.1, sidelobethreshold = 2.0,
+#                minpsffraction=0.05,
+#                maxpsffraction=0.8,
+                smallscalebias=0.6, threshold= mythresh, aterm =True, pblimit=-0.001, pbmask=0.0,
+                deconvolver=mydeconvolver, gridder='wproject', wprojplanes=mywproj, scales=[0,5,15],wbawp=False,
+                restoration = True, savemodel='modelcolumn', cyclefactor = 0.5, parallel=parallel,
+                interactive=False)
         return myoutimg
 
+def mysbtclean(myfile,myniter,mythresh,srno,cell,imsize, mynterms1,mywproj,clean_robust,nameprefix=None,parallel=None):
+        '''mytclean for the subband selfcal, which keeps an image that already exists'''
+        return mytclean(myfile,myniter,mythresh,srno,cell,imsize,mynterms1,mywproj,clean_robust,nameprefix=nameprefix,skipifexists=True,parallel=parallel)
 
 def myonlyclean(myfile,myniter,mythresh,srno,cell,imsize,mynterms1,mywproj,clean_robust):
         default(clean)
@@ -445,23 +513,58 @@ def myonlyclean(myfile,myniter,mythresh,srno,cell,imsize,mynterms1,mywproj,clean
         return myname
 
 
-def mysplit(myfile,srno):
-        filname_pre = getfields(myfile)[0]
-        default(mstransform)
-        mstransform(vis=myfile, field='0', spw='', datacolumn='corrected', outputvis=filname_pre+'-selfcal'+str(srno)+'.ms')
-        myoutvis=filname_pre+'-selfcal'+str(srno)+'.ms'
+def myimageandexport(myfile,myniter,mythresh,srno,cell,imsize,mynterms1,mywproj,clean_robust,nameprefix=None,mycleaner=None,parallel=None,force=False,tmpdir=''):
+        '''Images myfile with clean or tclean, as set by usetclean, and exports the image to a fits file. Returns the image name.
+        A dirty image (myniter = 0) is not made again if its fits file is newer than myfile and config_capture.ini, unless force is True.
+        Cleaned images are always made, because tclean also writes the model column that flagresidual and gaincal use.
+        With tmpdir set, tclean writes its images there and they are moved to the working directory after the export.'''
+        if mycleaner is None:
+                mycleaner = mytclean
+        if nameprefix is None:
+                nameprefix = getfields(myfile)[0]
+        if usetclean == False:
+                myimg = 'selfcal'+'img'+str(srno)
+        else:
+                myimg = mytcleanname(nameprefix,myniter,srno)
+        if force == False and myniter == 0 and myisnewer(myimg+'.fits',[myfile+'/table.dat','config_capture.ini']):
+                logging.info("%s.fits is newer than %s, the imaging is skipped.", myimg, myfile)
+                return myimg
+        if usetclean == False:
+                myimg = myonlyclean(myfile,myniter,mythresh,srno,cell,imsize,mynterms1,mywproj,clean_robust)
+                mytmpimg = myimg
+        elif tmpdir != '':
+                mytmpimg = mycleaner(myfile,myniter,mythresh,srno,cell,imsize,mynterms1,mywproj,clean_robust,nameprefix=os.path.join(tmpdir,nameprefix),parallel=parallel)
+        else:
+                myimg = mycleaner(myfile,myniter,mythresh,srno,cell,imsize,mynterms1,mywproj,clean_robust,nameprefix=nameprefix,parallel=parallel)
+                mytmpimg = myimg
+        if mynterms1 > 1:
+                exportfits(imagename=mytmpimg+'.image.tt0', fitsimage=myimg+'.fits')
+        else:
+                exportfits(imagename=mytmpimg+'.image', fitsimage=myimg+'.fits')
+# the images made in tmpdir are kept, so they are moved next to the fits file
+        if mytmpimg != myimg:
+                for mypath in glob.glob(mytmpimg+'.*'):
+                        myrm(os.path.basename(mypath))
+                        shutil.move(mypath,os.path.basename(mypath))
+        return myimg
+
+def mysplit(myfile,srno,nameprefix=None):
+        '''Writes the corrected data of field 0 to the next selfcal ms. split keeps an mms as an mms.'''
+        if nameprefix is None:
+                nameprefix = getfields(myfile)[0]
+        myoutvis = nameprefix+'-selfcal'+str(srno)+'.ms'
+        default(split)
+        split(vis=myfile, field='0', spw='', datacolumn='corrected', outputvis=myoutvis, keepmms=True, keepflags=True)
         return myoutvis
 
-def mysbsplit(myfile,srno):
-        filname_pre = getfields(myfile)[0]
-        default(mstransform)
-        mstransform(vis=myfile, field='0', spw='', datacolumn='corrected', outputvis=filname_pre+'-selfcal'+str(srno)+'.ms')
-        myoutvis=filname_pre+'-selfcal'+str(srno)+'.ms'
-        return myoutvis
+def mysbsplit(myfile,srno,nameprefix=None):
+        return mysplit(myfile,srno,nameprefix)
 
 
-def mygaincal_ap(myfile,myref,mygtable,srno,pap,mysolint,myuvrascal,mygainspw):
-        fprefix = getfields(myfile)[0]
+def mygaincal_ap(myfile,myref,mygtable,srno,pap,mysolint,myuvrascal,mygainspw,nameprefix=None):
+        if nameprefix is None:
+                nameprefix = getfields(myfile)[0]
+        fprefix = nameprefix
         if pap=='ap':
                 mycalmode='ap'
                 mysol= mysolint[srno] 
@@ -470,19 +573,19 @@ def mygaincal_ap(myfile,myref,mygtable,srno,pap,mysolint,myuvrascal,mygainspw):
                 mycalmode='p'
                 mysol= mysolint[srno] 
                 mysolnorm = False
-        if os.path.isdir(fprefix+str(pap)+str(srno)+'.GT'):
-                os.system('rm -rf '+fprefix+str(pap)+str(srno)+'.GT')
+        mycal = fprefix+pap+str(srno)+'.GT'
+        myrm(mycal)
         default(gaincal)
-        gaincal(vis=myfile, caltable=fprefix+str(pap)+str(srno)+'.GT', append=False, field='0', spw=mygainspw,
+        gaincal(vis=myfile, caltable=mycal, append=False, field='0', spw=mygainspw,
                 uvrange=myuvrascal, solint = mysol, refant = myref, minsnr = 2.0,solmode='L1R', gaintype = 'G',
                 solnorm= mysolnorm, calmode = mycalmode, gaintable = [], interp = ['nearest,nearestflag', 'nearest,nearestflag' ], 
                 parang = True )
-        mycal = fprefix+str(pap)+str(srno)+'.GT'
         return mycal
 
-def mysbgaincal_ap(myfile,xgt,myref,mygtable,srno,pap,mysolint,myuvrascal,mygainspw):
-
-        fprefix = getfields(myfile)[0]
+def mysbgaincal_ap(myfile,xgt,myref,mygtable,srno,pap,mysolint,myuvrascal,mygainspw,nameprefix=None):
+        if nameprefix is None:
+                nameprefix = getfields(myfile)[0]
+        fprefix = nameprefix
         if pap=='ap':
                 mycalmode='ap'
                 mysol= mysolint[srno] 
@@ -491,157 +594,130 @@ def mysbgaincal_ap(myfile,xgt,myref,mygtable,srno,pap,mysolint,myuvrascal,mygain
                 mycalmode='p'
                 mysol= mysolint[srno] 
                 mysolnorm = False
-        if os.path.isdir(fprefix+str(pap)+str(srno)+str('sb')+str(xgt)+'.GT'):
-                os.system('rm -rf '+str(pap)+str(srno)+str('sb')+str(xgt)+'.GT')
+        mycal = fprefix+pap+str(srno)+'sb'+str(xgt)+'.GT'
+        myrm(mycal)
         default(gaincal)
-        gaincal(vis=myfile, caltable=fprefix+str(pap)+str(srno)+str('sb')+str(xgt)+'.GT', append=False, field='0', spw=str(xgt),
+        gaincal(vis=myfile, caltable=mycal, append=False, field='0', spw=str(xgt),
                 uvrange=myuvrascal, solint = mysol, refant = myref, minsnr = 2.0,solmode='L1R', gaintype = 'G',
                 solnorm= mysolnorm, calmode = mycalmode, gaintable = [], interp = ['nearest,nearestflag', 'nearest,nearestflag' ], 
                 parang = True )
-                
-        mycal = fprefix+str(pap)+str(srno)+str('sb')+str(xgt)+'.GT'
         return mycal
 
 
 
-def myapplycal(myfile,mygaintables):
+def myapplycal(myfile,mygaintables,myfields='0',myspw=''):
+        '''applycal of the selfcal tables on one or more fields (comma separated) and spws in a single call'''
         default(applycal)
-        applycal(vis=myfile, field='0', gaintable=mygaintables, gainfield=['0'], applymode='calflag', 
+        applycal(vis=myfile, field=myfields, spw=myspw, gaintable=mygaintables, gainfield=[myfields], applymode='calflag', 
                  interp=['linear'], calwt=False, parang=False)
         print('Ran applycal.')
 
 
 def mysbapplycal(myfile,mygaintables,xgt):
-        default(applycal)
-        applycal(vis=myfile, field='0',spw=str(xgt), gaintable=mygaintables, gainfield=['0'], applymode='calflag', 
-                 interp=['linear'], calwt=False, parang=False)
-        print('Ran applycal.')
+        '''myapplycal on the subband xgt, or on all the subbands in a list of xgt at once'''
+        if isinstance(xgt,list):
+                myapplycal(myfile,mygaintables,'0',','.join([str(x) for x in xgt]))
+        else:
+                myapplycal(myfile,mygaintables,'0',str(xgt))
         
 
 
 def flagresidual(myfile,myclipresid,myflagspw):
+        '''rflag and clip on the residuals of the target (field 0) followed by a summary, in one pass over the data with flagdata in list mode'''
+        myflgcmds = ["mode='rflag' datacolumn='RESIDUAL_DATA' field='0' timedevscale=6.0 freqdevscale=6.0 spectralmax=500.0 extendflags=False",
+                "mode='clip' datacolumn='RESIDUAL_DATA' field='0' spw='%s' clipminmax=%s clipoutside=True clipzeros=True" % (myflagspw, myclipresid),
+                "mode='summary' datacolumn='RESIDUAL_DATA' field='0' name='%s'" % (myfile+'temp.summary')]
         default(flagdata)
-        flagdata(vis=myfile, mode ='rflag', datacolumn="RESIDUAL_DATA", field='', timecutoff=6.0,  freqcutoff=6.0,
-                timefit="line", freqfit="line",        flagdimension="freqtime", extendflags=False, timedevscale=6.0,
-                freqdevscale=6.0, spectralmax=500.0, extendpols=False, growaround=False, flagneartime=False,
-                flagnearfreq=False, action="apply", flagbackup=True, overwrite=True, writeflags=True)
-        default(flagdata)
-        flagdata(vis=myfile, mode ='clip', datacolumn="RESIDUAL_DATA", clipminmax=myclipresid,
-                clipoutside=True, clipzeros=True, field='', spw=myflagspw, extendflags=False,
-                extendpols=False, growaround=False, flagneartime=False,        flagnearfreq=False,
-                action="apply",        flagbackup=True, overwrite=True, writeflags=True)
-        flagdata(vis=myfile,mode="summary",datacolumn="RESIDUAL_DATA", extendflags=False, 
-                name=myfile+'temp.summary', action="apply", flagbackup=True,overwrite=True, writeflags=True)
+        flagdata(vis=myfile, mode='list', inpfile=myflgcmds, action='apply', flagbackup=True)
 #
 
 
          
 
-def myselfcal(myfile,myref,nloops,nploops,myvalinit,mycellsize,myimagesize,mynterms2,mywproj1,mysolint1,myclipresid,myflagspw,mygainspw2,mymakedirty,niterstart,clean_robust):
+def myselfcaldone(myimg,mynterms,myfluxes,convtol,nstable):
+        '''Adds the model flux of myimg to myfluxes and returns True once it has changed by less than convtol (fractional) for nstable rounds in a row. A convtol of 0 never stops.'''
+        if convtol <= 0:
+                return False
+        if mynterms > 1:
+                mymodel = myimg+'.model.tt0'
+        else:
+                mymodel = myimg+'.model'
+        myfluxes.append(float(imstat(imagename=mymodel)['sum'][0]))
+        logging.info("Model flux of %s is %s", myimg, myfluxes[-1])
+        if len(myfluxes) <= nstable:
+                return False
+        for k in range(len(myfluxes)-nstable,len(myfluxes)):
+                if abs(myfluxes[k]-myfluxes[k-1]) >= convtol*max(abs(myfluxes[k-1]),1E-12):
+                        return False
+        return True
+
+def myselfcal(myfile,myref,nloops,nploops,myvalinit,mycellsize,myimagesize,mynterms2,mywproj1,mysolint1,myclipresid,myflagspw,mygainspw2,mymakedirty,niterstart,clean_robust,parallel=None,convtol=0.0,nstable=2,niterend=150000,tmpdir=''):
         myref = myref
         nscal = nloops # number of selfcal loops
         npal = nploops # number of phasecal loops
         # selfcal loop
         myimages=[]
         mygt=[]
+        myfluxes=[]
         myniterstart = niterstart
-        myniterend = 200000        
+# multi-term clean spends its niter on every term, so the cap is shared between the terms
+        myniterend = niterend//max(mynterms2,1)
+# niter is doubled with every round up to myniterend and the threshold goes down as 1/(i+1); both are worked out before the loop
+        niterlist = np.minimum(myniterstart*2**np.arange(nscal+1), myniterend).astype(int)
+        threshlist = [str(myvalinit/(i+1))+'mJy' for i in range(0,nscal+1)]
+# all the selfcal files hold the single target field, so the name prefix is read once
+        myprefix = getfields(myfile[0])[0]
         if nscal == 0:
                 i = nscal
                 myniter = 0 # this is to make a dirty image
-                mythresh = str(myvalinit/(i+1))+'mJy'
+                mythresh = threshlist[i]
                 print("Using "+ myfile[i]+" for making only an image.")
-                if usetclean == False:
-                        myimg = myonlyclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust)   # clean
-                else:
-                        myimg = mytclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust)   # tclean
-                if mynterms2 > 1:
-                        exportfits(imagename=myimg+'.image.tt0', fitsimage=myimg+'.fits')
-                else:
-                        exportfits(imagename=myimg+'.image', fitsimage=myimg+'.fits')
+                myimg = myimageandexport(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust,nameprefix=myprefix,parallel=parallel,tmpdir=tmpdir)
 
         else:
                 for i in range(0,nscal+1): # plan 4 P and 4AP iterations
                         if mymakedirty == True:
                                 if i == 0:
                                         myniter = 0 # this is to make a dirty image
-                                        mythresh = str(myvalinit/(i+1))+'mJy'
+                                        mythresh = threshlist[i]
                                         print("Using "+ myfile[i]+" for making only a dirty image.")
-                                        if usetclean == False:
-                                                myimg = myonlyclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust)   # clean
-                                        else:
-                                                myimg = mytclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust)   # tclean
-                                        if mynterms2 > 1:
-                                                exportfits(imagename=myimg+'.image.tt0', fitsimage=myimg+'.fits')
-                                        else:
-                                                exportfits(imagename=myimg+'.image', fitsimage=myimg+'.fits')
+                                        myimg = myimageandexport(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust,nameprefix=myprefix,parallel=parallel,tmpdir=tmpdir)
 
                         else:
-                                myniter=int(myniterstart*2**i) #myniterstart*(2**i)  # niter is doubled with every iteration int(startniter*2**count)
-                                if myniter > myniterend:
-                                        myniter = myniterend
-                                mythresh = str(myvalinit/(i+1))+'mJy'
+                                myniter = int(niterlist[i])
+                                mythresh = threshlist[i]
+# the first npal rounds solve for phase only, with the uvrascal uv-range; the rest solve for amplitude and phase
                                 if i < npal:
                                         mypap = 'p'
-#                                        print("Using "+ myfile[i]+" for imaging.")
-                                        try:
-                                                assert os.path.isdir(myfile[i])
-                                        except AssertionError:
-                                                logging.info("The MS file not found for imaging.")
-                                                sys.exit()
-                                        logging.info("Using "+ myfile[i]+" for imaging.")
-                                        if usetclean == False:
-                                                myimg = myonlyclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust)   # clean
-                                        else:
-                                                myimg = mytclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust)   # tclean
-                                        if mynterms2 > 1:
-                                                exportfits(imagename=myimg+'.image.tt0', fitsimage=myimg+'.fits')
-                                        else:
-                                                exportfits(imagename=myimg+'.image', fitsimage=myimg+'.fits')
-                                        myimages.append(myimg)        # list of all the images created so far
-                                        flagresidual(myfile[i],clipresid,'')
-                                        if i>0:
-                                                myctables = mygaincal_ap(myfile[i],myref,mygt[i-1],i,mypap,mysolint1,uvrascal,mygainspw2)
-                                        else:                                        
-                                                myctables = mygaincal_ap(myfile[i],myref,mygt,i,mypap,mysolint1,uvrascal,mygainspw2)                                                
-                                        mygt.append(myctables) # full list of gaintables
-                                        if i < nscal+1:
-                                                myapplycal(myfile[i],mygt[i])
-                                                myoutfile= mysplit(myfile[i],i)
-                                                myfile.append(myoutfile)
+                                        myuvra = uvrascal
                                 else:
                                         mypap = 'ap'
-#                                        print("Using "+ myfile[i]+" for imaging.")
-                                        try:
-                                                assert os.path.isdir(myfile[i])
-                                        except AssertionError:
-                                                logging.info("The MS file not found for imaging.")
-                                                sys.exit()
-                                        if usetclean == False:
-                                                myimg = myonlyclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust)   # clean
-                                        else:
-                                                myimg = mytclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust)   # tclean
-                                        if mynterms2 > 1:
-                                                exportfits(imagename=myimg+'.image.tt0', fitsimage=myimg+'.fits')
+                                        myuvra = ''
+                                myrequire(myfile[i], "The MS file not found for imaging.")
+                                logging.info("Using "+ myfile[i]+" for imaging.")
+                                myimg = myimageandexport(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust,nameprefix=myprefix,parallel=parallel,tmpdir=tmpdir)
+                                myimages.append(myimg)        # list of all the images created so far
+                                if myselfcaldone(myimg,mynterms2,myfluxes,convtol,nstable):
+                                        logging.info("The model flux has stopped changing, selfcal ends with "+myimg)
+                                        break
+                                flagresidual(myfile[i],clipresid,'')
+# the image of the last round is the final one, so no gains are solved for after it
+                                if i < nscal:
+                                        if i > 0:
+                                                myctables = mygaincal_ap(myfile[i],myref,mygt[i-1],i,mypap,mysolint1,myuvra,mygainspw2,nameprefix=myprefix)
                                         else:
-                                                exportfits(imagename=myimg+'.image', fitsimage=myimg+'.fits')
-                                        myimages.append(myimg)        # list of all the images created so far
-                                        flagresidual(myfile[i],clipresid,'')
-                                        if i!= nscal:
-                                                myctables = mygaincal_ap(myfile[i],myref,mygt[i-1],i,mypap,mysolint1,'',mygainspw2)
-                                                mygt.append(myctables) # full list of gaintables
-                                                if i < nscal+1:
-                                                        myapplycal(myfile[i],mygt[i])
-                                                        myoutfile= mysplit(myfile[i],i)
-                                                        myfile.append(myoutfile)
+                                                myctables = mygaincal_ap(myfile[i],myref,mygt,i,mypap,mysolint1,myuvra,mygainspw2,nameprefix=myprefix)
+                                        mygt.append(myctables) # full list of gaintables
+                                        myapplycal(myfile[i],mygt[i])
+                                        myoutfile= mysplit(myfile[i],i,nameprefix=myprefix)
+                                        myfile.append(myoutfile)
 #                                print("Visibilities from the previous selfcal will be deleted.")
                                 logging.info("Visibilities from the previous selfcal will be deleted.")
                                 if i < nscal:
-                                        fprefix = getfields(myfile[i])[0]
-                                        myoldvis = fprefix+'-selfcal'+str(i-1)+'.ms'
+                                        myoldvis = myprefix+'-selfcal'+str(i-1)+'.ms'
 #                                        print("Deleting "+str(myoldvis))
-                                        logging.info("Deleting "+str(myoldvis))
-                                        os.system('rm -rf '+str(myoldvis))
+                                        logging.info("Deleting "+myoldvis)
+                                        myrm(myoldvis,myoldvis+'.flagversions')
 #                        print('Ran the selfcal loop')
         return myfile, mygt, myimages
 
@@ -654,199 +730,146 @@ def myselfcal(myfile,myref,nloops,nploops,myvalinit,mycellsize,myimagesize,mynte
 #        return nspw
 
 def getspws(myfile):
-        nspws = vishead(vis =myfile,mode ='list',listitems='freq_group_name')
-        nspw = len(nspws['freq_group_name'][0])
-        return nspw
+        return getmsinfo(myfile)['nspw']
 
 
-def makesubbands(myfile,subbandchan):
-#        if os.path.isdir(str(msimg*)) == True:
-        try:
-                os.system('rm -rf msimg*')
-        except (RuntimeError, TypeError, NameError):
-                pass
+def mysubbandsplit(myfile,myoutvis,myspw):
+        '''Writes one subband of myfile with all its data columns to myoutvis.'''
+# a tile holds all the correlations and channels of the subband for as many rows as fit in about 1 MiB of complex data,
+# so that imaging and gaincal read whole rows from one tile
+        mychans = myspw.split(':')[1].split('~')
+        mynchan = int(mychans[1])-int(mychans[0])+1
+        myncorr = getmsinfo(myfile)['npol']
+        mynrows = max(1,2**20//(8*myncorr*mynchan))
+        default(mstransform)
+        mstransform(vis=myfile,outputvis=myoutvis,spw=myspw,chanaverage=False,datacolumn='all',realmodelcol=True,tileshape=[myncorr,mynchan,mynrows])
+        return myoutvis
+
+def makesubbands(myfile,subbandchan,nproc=1):
+        myrm(*glob.glob('msimg*'))
         splitspw=[]
         msspw=[]
         gainsplitspw=[]
         xchan=subbandchan
         myx=getnchan(myfile)
         if myx>xchan:
-                mynchani=myx
-                xs=0
-                while mynchani>0:
-                        if mynchani>xchan:
-                            spwi='0:'+str(xs*xchan)+'~'+str(((xs+1)*xchan)-1)
-                            if xs==0:
-                                gspwi='0:'+str(0)+'~'+str(((xs+1)*xchan)-1)
-                            else:
-                                gspwi='0:'+str(0)+'~'+str(xchan-1)
-                        if mynchani<=xchan:
-                            spwi='0:'+str(xs*xchan)+'~'+str((xs*xchan)+mynchani-1)
-                            gspwi='0:'+str(0)+'~'+str(mynchani-1)
-                        gainsplitspw.append(gspwi)
-                        msspw.append(spwi)
-                        mynchani=mynchani-xchan
-                        myfilei="msimg"+str(xs)+".ms"
-                        xs=xs+1
-                        splitspw.append(myfilei)
+# subband k covers channels k*xchan to (k+1)*xchan-1, and the last one ends at the last channel
+                nsub = -(-myx//xchan)
+                starts = np.arange(nsub)*xchan
+                ends = np.minimum(starts+xchan,myx)-1
+                msspw = ['0:'+str(x)+'~'+str(y) for x, y in zip(starts, ends)]
+                gainsplitspw = ['0:0~'+str(y-x) for x, y in zip(starts, ends)]
+                splitspw = ["msimg"+str(xs)+".ms" for xs in range(0,nsub)]
                 logging.info(gainsplitspw)
                 logging.info(msspw)
                 logging.info(splitspw)
-                for numspw in range(0,len(msspw)):
-                        default(mstransform)
-                        mstransform(vis=myfile,outputvis=splitspw[numspw],spw=msspw[numspw],chanaverage=False,datacolumn='all',realmodelcol=True)
-                if os.path.isdir(" old"+myfile) == True:
-                        os.system("rm -r"+" old"+myfile)
-                if os.path.isdir(" old"+myfilei+".flagversions") == True:
-                        os.system("rm -r"+" old"+myfile+".flagversions")
-                os.system("mv "+myfile+".flagversions old"+myfile+".flagversions")
-                os.system("mv  "+myfile+" old"+myfile)
-                concat(vis=splitspw,concatvis=myfile)
+# the subbands go to separate files, so they are written side by side on nproc processes
+                myparmap(mysubbandsplit,[(myfile,splitspw[numspw],msspw[numspw]) for numspw in range(0,len(msspw))],nproc)
+                myrm('old'+myfile,'old'+myfile+'.flagversions')
+                if os.path.isdir(myfile+'.flagversions'):
+                        shutil.move(myfile+'.flagversions','old'+myfile+'.flagversions')
+                shutil.move(myfile,'old'+myfile)
+# the subband files become the sub-ms of a multi-ms in place of myfile, without copying the rows again
+                virtualconcat(vis=splitspw,concatvis=myfile,copypointing=False)
         mygainspw2=gainsplitspw
         return mygainspw2, msspw
 
 
-def mysubbandselfcal(myfile,subbandchan,myref,nloops,nploops,myvalinit,mycellsize,myimagesize,mynterms2,mywproj1,mysolint1,myclipresid,myflagspw,mygainspw2,mymakedirty,niterstart,msspw,clean_robust):
+def mysubbandselfcal(myfile,subbandchan,myref,nloops,nploops,myvalinit,mycellsize,myimagesize,mynterms2,mywproj1,mysolint1,myclipresid,myflagspw,mygainspw2,mymakedirty,niterstart,msspw,clean_robust,parallel=None,convtol=0.0,nstable=2,niterend=150000,tmpdir=''):
         myref = myref
         nscal = nloops # number of selfcal loops
         npal = nploops # number of phasecal loops
         # selfcal loop
         myimages=[]
         mygt=[]
+        myfluxes=[]
         myniterstart = niterstart
-        myniterend = 200000        
+# multi-term clean spends its niter on every term, so the cap is shared between the terms
+        myniterend = niterend//max(mynterms2,1)
+# niter is doubled with every round up to myniterend and the threshold goes down as 1/(i+1); both are worked out before the loop
+        niterlist = np.minimum(myniterstart*2**np.arange(nscal+1), myniterend).astype(int)
+        threshlist = [str(myvalinit/(i+1))+'mJy' for i in range(0,nscal+1)]
+# all the selfcal files hold the single target field, so the name prefix is read once
+        myprefix = getfields(myfile[0])[0]
         if nscal == 0:
                 i = nscal
                 myniter = 0 # this is to make a dirty image
-                mythresh = str(myvalinit/(i+1))+'mJy'
+                mythresh = threshlist[i]
                 print("Using "+ myfile[i]+" for making only an image.")
-                if usetclean == False:
-                        myimg = myonlyclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust)   # clean
-                else:
-                        myimg = mytclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust)   # tclean
-                if mynterms2 > 1:
-                        exportfits(imagename=myimg+'.image.tt0', fitsimage=myimg+'.fits')
-                else:
-                        exportfits(imagename=myimg+'.image', fitsimage=myimg+'.fits')
+                myimg = myimageandexport(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust,nameprefix=myprefix,parallel=parallel,tmpdir=tmpdir)
 
         else:
                 for i in range(0,nscal+1): # plan 4 P and 4AP iterations
                         if mymakedirty == True:
                                 if i == 0:
                                         myniter = 0 # this is to make a dirty image
-                                        mythresh = str(myvalinit/(i+1))+'mJy'
+                                        mythresh = threshlist[i]
                                         print("Using "+ myfile[i]+" for making only a dirty image.")
-                                        if usetclean == False:
-                                                myimg = myonlyclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust)   # clean
-                                        else:
-                                                myimg = mytclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust)   # tclean
-                                        if mynterms2 > 1:
-                                                exportfits(imagename=myimg+'.image.tt0', fitsimage=myimg+'.fits')
-                                        else:
-                                                exportfits(imagename=myimg+'.image', fitsimage=myimg+'.fits')
+                                        myimg = myimageandexport(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust,nameprefix=myprefix,parallel=parallel,tmpdir=tmpdir)
 
                         else:
-                                myniter=int(myniterstart*2**i) #myniterstart*(2**i)  # niter is doubled with every iteration int(startniter*2**count)
-                                if myniter > myniterend:
-                                        myniter = myniterend
-                                mythresh = str(myvalinit/(i+1))+'mJy'
+                                myniter = int(niterlist[i])
+                                mythresh = threshlist[i]
+# the first npal rounds solve for phase only, with the uvrascal uv-range; the rest solve for amplitude and phase
                                 if i < npal:
                                         mypap = 'p'
-#                                        print("Using "+ myfile[i]+" for imaging.")
-                                        try:
-                                                assert os.path.isdir(myfile[i])
-                                        except AssertionError:
-                                                logging.info("The MS file not found for imaging.")
-                                                sys.exit()
-                                        logging.info("Using "+ myfile[i]+" for imaging.")
-                                        if usetclean == False:
-                                                myimg = myonlyclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust)   # clean
-                                        else:
-                                                myimg = mysbtclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust)   # tclean
-                                        if mynterms2 > 1:
-                                                exportfits(imagename=myimg+'.image.tt0', fitsimage=myimg+'.fits')
-                                        else:
-                                                exportfits(imagename=myimg+'.image', fitsimage=myimg+'.fits')
-                                        myimages.append(myimg)        # list of all the images created so far
-                                        flagresidual(myfile[i],clipresid,'')
-                                        if i>0:
-                                                myctables = mygaincal_ap(myfile[i],myref,mygt[i-1],i,mypap,mysolint1,uvrascal,mygainspw2)
-                                        else:
-                                                myctables = mygaincal_ap(myfile[i],myref,mygt,i,mypap,mysolint1,uvrascal,mygainspw2)
-                                        mygt.append(myctables)
-                                        if i < nscal+1:
-                                                myapplycal(myfile[i],mygt[i])
-                                                myoutfile= mysplit(myfile[i],i)
-                                                myfile.append(myoutfile)
+                                        myuvra = uvrascal
                                 else:
                                         mypap = 'ap'
-#                                        print("Using "+ myfile[i]+" for imaging.")
-                                        try:
-                                                assert os.path.isdir(myfile[i])
-                                        except AssertionError:
-                                                logging.info("The MS file not found for imaging.")
-                                                sys.exit()
-                                        if usetclean == False:
-                                                myimg = myonlyclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust)   # clean
-                                        else:
-                                                myimg = mysbtclean(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust)   # tclean
-                                        if mynterms2 > 1:
-                                                exportfits(imagename=myimg+'.image.tt0', fitsimage=myimg+'.fits')
+                                        myuvra = ''
+                                myrequire(myfile[i], "The MS file not found for imaging.")
+                                logging.info("Using "+ myfile[i]+" for imaging.")
+                                myimg = myimageandexport(myfile[i],myniter,mythresh,i,mycellsize,myimagesize,mynterms2,mywproj1,clean_robust,nameprefix=myprefix,mycleaner=mysbtclean,parallel=parallel,tmpdir=tmpdir)
+                                myimages.append(myimg)        # list of all the images created so far
+                                if myselfcaldone(myimg,mynterms2,myfluxes,convtol,nstable):
+                                        logging.info("The model flux has stopped changing, selfcal ends with "+myimg)
+                                        break
+                                flagresidual(myfile[i],clipresid,'')
+# the image of the last round is the final one, so no gains are solved for after it
+                                if i < nscal:
+                                        if i > 0:
+                                                myctables = mygaincal_ap(myfile[i],myref,mygt[i-1],i,mypap,mysolint1,myuvra,mygainspw2,nameprefix=myprefix)
                                         else:
-                                                exportfits(imagename=myimg+'.image', fitsimage=myimg+'.fits')
-                                        myimages.append(myimg)        # list of all the images created so far
-                                        flagresidual(myfile[i],clipresid,'')
-                                        if i!=nscal:
-                                                myctables = mygaincal_ap(myfile[i],myref,mygt[i-1],i,mypap,mysolint1,'',mygainspw2)
-                                                mygt.append(myctables) # full list of gaintables
-                                                if i < nscal+1:
-                                                        myapplycal(myfile[i],mygt[i])
-                                                        myoutfile= mysplit(myfile[i],i)
-                                                        myfile.append(myoutfile)
+                                                myctables = mygaincal_ap(myfile[i],myref,mygt,i,mypap,mysolint1,myuvra,mygainspw2,nameprefix=myprefix)
+                                        mygt.append(myctables) # full list of gaintables
+                                        myapplycal(myfile[i],mygt[i])
+                                        myoutfile= mysplit(myfile[i],i,nameprefix=myprefix)
+                                        myfile.append(myoutfile)
                                 logging.info("Visibilities from the previous selfcal will be deleted.")
                                 if i < nscal:
-                                        fprefix = getfields(myfile[i])[0]
-                                        myoldvis = fprefix+'-selfcal'+str(i-1)+'.ms'
+                                        myoldvis = myprefix+'-selfcal'+str(i-1)+'.ms'
 #                                        print("Deleting "+str(myoldvis))
-                                        logging.info("Deleting "+str(myoldvis))
-                                        os.system('rm -rf '+str(myoldvis))
+                                        logging.info("Deleting "+myoldvis)
+                                        myrm(myoldvis,myoldvis+'.flagversions')
 #                        print('Ran the selfcal loop')
         return myfile, mygt, myimages
 
 
 
 def flagsummary(myfile):
-        try:
-                assert os.path.isdir(myfile), "The MS file was not found."
-        except AssertionError:
-                logging.info("The MS file was not found.")
-                sys.exit()
+        myrequire(myfile, "The MS file was not found.")
         s = flagdata(vis=myfile, mode='summary')
         allkeys = s.keys()
         logging.info("Flagging percentage:")
         for x in allkeys:
                 try:
-                        for y in s[x].keys():
-                                flagged_percent = 100.*(s[x][y]['flagged']/s[x][y]['total'])
-#                                logging.info(x, y, "%0.2f" % flagged_percent, "% flagged.")
-                                logstring = str(x)+' '+str(y)+' '+str(flagged_percent)
-                                logging.info(logstring)
+                        ykeys = list(s[x].keys())
                 except AttributeError:
-                        pass
+                        continue
+                if len(ykeys) == 0:
+                        continue
+# the percentages for all the entries of x are worked out together and logged in one go
+                flagged = np.fromiter((s[x][y]['flagged'] for y in ykeys), dtype=np.float64, count=len(ykeys))
+                total = np.fromiter((s[x][y]['total'] for y in ykeys), dtype=np.float64, count=len(ykeys))
+                flagged_percent = 100.*flagged/np.maximum(total,1)
+#                logging.info(x, y, "%0.2f" % flagged_percent, "% flagged.")
+                logging.info("\n".join([str(x)+' '+str(ykeys[k])+' '+str(flagged_percent[k]) for k in range(0,len(ykeys))]))
 
 
 #############End of functions##############################################################################
 ###### MSJ
 def myrm_un(myfields) :
-	x=[]
-	for fld in myfields :
-		if "_" in fld :
-			fld = fld[:-2]
-			x.append(fld)
-		else :
-			x.append(fld)
-	myfields=x
-	return myfields
+	return [fld[:-2] if "_" in fld else fld for fld in myfields]
 
 def my_dig_plot(msfilename,myfields,myampcals,mypcals,mytargets,mycalsuffix,bptable,gntable):
 	print (msfilename,myfields,myampcals,mypcals,mycalsuffix,bptable,gntable)
@@ -855,10 +878,8 @@ def my_dig_plot(msfilename,myfields,myampcals,mypcals,mytargets,mycalsuffix,bpta
 	if not os.path.exists(plt_dir):
 		os.makedirs(plt_dir)
 
-	msmd.open(msfilename)  
-	nf = msmd.nfields()
-	nchan = msmd.nchan(0)
-	msmd.done()
+	nf = len(getfields(msfilename))
+	nchan = getnchan(msfilename)
 
 	fld_list=[]
 	for i in range(nf):
@@ -881,33 +902,33 @@ def my_dig_plot(msfilename,myfields,myampcals,mypcals,mytargets,mycalsuffix,bpta
 
 	# amp and uvdist Plot at different channels
 	# amp and phase Plot at different channels
+	# the sample channels go into one plot per field, coloured by channel, so the ms is read once per plot
 	step=int(nchan/8)
-	for j in range (0,nchan,step) :
-		if j >= int(nchan/10) and j <= int(nchan/1.1) :
-			n_spw='0:'+str(j)+'~'+str(j)
-			for i in range(len(fld_list)) :
-				fld=fld_list[i]
-				sname=myfields[fld]
-				pfile=plt_dir+'/'+sname+'_'+str(j)+"_"+mycalsuffix+'_amp_uvdist.png'
-				if sname in myampcals : pltrange=[0,0,0,0]
-				else : pltrange=[0,0,0,0]
-				#print msfilename,fld,n_spw,pltrange,pfile
-				if os.path.exists('plotms.last'): os.remove('plotms.last')
-				plotms(vis=msfilename,field=str(fld),xaxis="uvdist",yaxis="amp",xdatacolumn="corrected",
-					ydatacolumn="corrected",spw=n_spw,scan="",averagedata=False,avgtime="",avgscan=False,
-					plotrange=pltrange, overwrite=True,showgui=False,avgbaseline=True,symbolsize=2,
-					plotfile=pfile,clearplots=True)
-				plot_files.append(pfile)
-
-				pfile=plt_dir+'/'+sname+'_'+str(j)+"_"+mycalsuffix+'_amp_phase.png'
-				pltrange=[0,0,-180,180]
-				#print msfilename,fld,n_spw,pltrange,pfile
-				if os.path.exists('plotms.last'): os.remove('plotms.last')
-				plotms(vis=msfilename,field=str(fld),xaxis="amp",yaxis="phase",xdatacolumn="corrected",
-					ydatacolumn="corrected",spw=n_spw,scan="",averagedata=False,avgtime="",avgscan=False,
-					plotrange=pltrange, overwrite=True,showgui=False,avgbaseline=True,symbolsize=2,
-					plotfile=pfile,clearplots=True)
-				plot_files.append(pfile)
+	plt_chans=[j for j in range(0,nchan,step) if j >= int(nchan/10) and j <= int(nchan/1.1)]
+	n_spw='0:'+';'.join([str(j)+'~'+str(j) for j in plt_chans])
+	for i in range(len(fld_list)) :
+		fld=fld_list[i]
+		sname=myfields[fld]
+		pfile=plt_dir+'/'+sname+"_"+mycalsuffix+'_amp_uvdist.png'
+		if sname in myampcals : pltrange=[0,0,0,0]
+		else : pltrange=[0,0,0,0]
+		#print msfilename,fld,n_spw,pltrange,pfile
+		if os.path.exists('plotms.last'): os.remove('plotms.last')
+		plotms(vis=msfilename,field=str(fld),xaxis="uvdist",yaxis="amp",xdatacolumn="corrected",
+			ydatacolumn="corrected",spw=n_spw,scan="",averagedata=False,avgtime="",avgscan=False,
+			plotrange=pltrange, overwrite=True,showgui=False,avgbaseline=True,symbolsize=2,
+			coloraxis='chan',plotfile=pfile,clearplots=True)
+		plot_files.append(pfile)
+
+		pfile=plt_dir+'/'+sname+"_"+mycalsuffix+'_amp_phase.png'
+		pltrange=[0,0,-180,180]
+		#print msfilename,fld,n_spw,pltrange,pfile
+		if os.path.exists('plotms.last'): os.remove('plotms.last')
+		plotms(vis=msfilename,field=str(fld),xaxis="amp",yaxis="phase",xdatacolumn="corrected",
+			ydatacolumn="corrected",spw=n_spw,scan="",averagedata=False,avgtime="",avgscan=False,
+			plotrange=pltrange, overwrite=True,showgui=False,avgbaseline=True,symbolsize=2,
+			coloraxis='chan',plotfile=pfile,clearplots=True)
+		plot_files.append(pfile)
 
 	# bandpass and gaincal, amp and phase plots
 	bp_list=[]